@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 Johannes Grassler. See the LICENSE file for more information.
+#
+# Compares serving a cache entry (reading the payload, decompressing and
+# unpickling it) with regenerating the result, for each of the codecs
+# papercut_cache supports. The overview is regenerated the way the XenForo
+# backend builds it, so the "backend" column is a lower bound for the work a
+# cache hit replaces (no API or database round trip is included).
+#
+# Usage: python bench/cache_compression.py [--posts N] [--rounds N]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import papercut.papercut_cache as papercut_cache
+import papercut.storage.strutil as strutil
+
+WORDS = ('indy', 'octane', 'irix', 'mips', 'r10000', 'crimson', 'onyx',
+         'fuel', 'tezro', 'scsi', 'nekoware', 'the', 'a', 'of', 'and', 'to',
+         'with', 'boot', 'prom', 'graphics', 'board', 'memory', 'quote')
+
+
+def synthetic_posts(count):
+    posts = []
+    now = int(time.time())
+    for i in range(count):
+        thread = i // 20
+        posts.append({
+            'post_id': 1000 + i,
+            'post_date': now - (count - i) * 600,
+            'username': 'user%d' % random.randint(1, 500),
+            'nntp_subject': 'Re: %s' % ' '.join(random.sample(WORDS, 5)),
+            'nntp_message_id': '<%d.%d@forums.sgi.sh>' % (now, 1000 + i),
+            'reference': '<%d.%d@forums.sgi.sh>' % (now, 1000 + thread * 20),
+        })
+    return posts
+
+
+def render_overview(posts):
+    overviews = []
+    for index, post in enumerate(posts):
+        msg_num = index + 1
+        overviews.append("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
+            msg_num,
+            post['nntp_subject'],
+            post['username'],
+            strutil.get_formatted_time(time.localtime(post['post_date'])),
+            post['nntp_message_id'],
+            post['reference'],
+            8192,
+            50,
+            'Xref: %s %s:%s' % ('localhost', 'sgug.bench', msg_num)
+        ))
+    return "\r\n".join(overviews)
+
+
+def render_article(words):
+    lines = []
+    for i in range(0, words, 12):
+        lines.append(' '.join(random.choice(WORDS) for j in range(12)))
+    return ('Path: localhost\r\nFrom: user1\r\nSubject: bench', "\r\n".join(lines))
+
+
+def timed(func, rounds):
+    '''Returns the mean run time of func() in milliseconds'''
+    start = time.perf_counter()
+    for i in range(rounds):
+        func()
+    return (time.perf_counter() - start) * 1000.0 / rounds
+
+
+def main():
+    opts = argparse.ArgumentParser(description='Cache compression benchmark')
+    opts.add_argument('--posts', type=int, default=5000,
+                      help='number of posts in the overview (default: 5000)')
+    opts.add_argument('--rounds', type=int, default=20,
+                      help='repetitions per measurement (default: 20)')
+    opts.add_argument('-c', '--config', action='append',
+                      help='ignored, accepted for papercut.settings')
+    args = opts.parse_args()
+
+    random.seed(0)
+    posts = synthetic_posts(args.posts)
+    payloads = [
+        ('get_XOVER', render_overview(posts), lambda: render_overview(posts)),
+        ('get_ARTICLE', render_article(args.posts), None),
+    ]
+
+    print('%-12s %-5s %10s %10s %6s %10s %10s %10s' % (
+        'method', 'codec', 'raw', 'stored', 'ratio', 'encode ms',
+        'decode ms', 'backend ms'))
+    for method, result, regenerate in payloads:
+        backend = '-'
+        if regenerate is not None:
+            backend = '%.3f' % timed(regenerate, args.rounds)
+        for codec in ['none'] + sorted(papercut_cache.codecs):
+            used, payload, raw_size = papercut_cache.encode_entry(result, codec)
+            encode = timed(lambda: papercut_cache.encode_entry(result, codec),
+                           args.rounds)
+            decode = timed(lambda: papercut_cache.decode_entry(used, payload),
+                           args.rounds)
+            print('%-12s %-5s %10d %10d %5.1fx %10.3f %10.3f %10s' % (
+                method, codec, raw_size, len(payload),
+                float(raw_size) / len(payload), encode, decode, backend))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 Johannes Grassler. See the LICENSE file for more information.
+#
+# Times the XenForo backend against the mock API in bench/xenforo_mock.py:
+# the full crawl of a fresh spool, a sync with nothing new, an incremental
+# sync after the board grew, one after posts were edited and deleted,
+# compacting into the snapshot file, a restart from the snapshot, and XOVER
+# and BODY throughput over the result. The spool is a temporary directory,
+# removed afterwards unless --keep is given.
+#
+# Usage: python bench/xenforo_crawl.py [--forums N] [--posts N] [--grow N]
+#            [--edit N] [--delete N] [--latency MS] [--rate-limit FRACTION]
+#            [--concurrency N] [--lazy-bodies] [--keep]
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import xenforo_mock
+import papercut.storage.xenforo_api as xenforo_api
+import papercut.storage.xenforo_common as xenforo_common
+
+
+def configure(url, spool, args):
+    '''Points the backend at the mock; both modules have their own settings'''
+    for module in (xenforo_api, xenforo_common):
+        module.settings.xenforo_api_key = 'bench'
+        module.settings.xenforo_api_url = url
+        module.settings.xenforo_api_spool = spool
+        module.settings.xenforo_api_sync_interval = 0
+        module.settings.xenforo_api_webhook_port = 0
+        module.settings.xenforo_api_concurrency = args.concurrency
+        module.settings.xenforo_api_lazy_bodies = 'yes' if args.lazy_bodies else 'no'
+        module.settings.xenforo_api_body_cache_disk = 'no'
+
+
+def restart():
+    '''Forgets the backend's shared state, as a restarted server would'''
+    xenforo_common.Borg._shared_state.clear()
+    return xenforo_api.Papercut_Storage()
+
+
+def timed(name, server, function, *args):
+    requests = server.stats['requests']
+    started = time.time()
+    result = function(*args)
+    elapsed = time.time() - started
+    print("%-22s %9.3fs %8d requests" % (name, elapsed, server.stats['requests'] - requests))
+    return result, elapsed
+
+
+def xover(storage, size):
+    lines = 0
+    for group in storage.xn.snapshots:
+        count, low, high = storage.get_GROUP('sgug.%s' % group)
+        for start in range(low, high + 1, size):
+            lines += storage.get_XOVER('sgug.%s' % group, start, start + size - 1).count('\r\n') + 1
+    return lines
+
+
+def bodies(storage, count):
+    rng = random.Random(1)
+    groups = list(storage.xn.snapshots)
+    size = 0
+    for i in range(count):
+        group = rng.choice(groups)
+        msgcount, low, high = storage.get_GROUP('sgug.%s' % group)
+        body = storage.get_BODY('sgug.%s' % group, str(rng.randint(low, high)))
+        size += len(body or '')
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the XenForo backend against the mock API')
+    parser.add_argument('--forums', type=int, default=10)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--grow', type=int, default=1000, help='posts added before the incremental sync')
+    parser.add_argument('--edit', type=int, default=100, help='posts edited before the next sync')
+    parser.add_argument('--delete', type=int, default=100, help='posts deleted before the next sync')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to each request')
+    parser.add_argument('--rate-limit', type=float, default=0, help='share of requests answered with 429')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--xover-size', type=int, default=500)
+    parser.add_argument('--bodies', type=int, default=1000)
+    parser.add_argument('--lazy-bodies', action='store_true')
+    parser.add_argument('--keep', action='store_true', help='keep the spool directory')
+    args = parser.parse_args()
+
+    board = xenforo_mock.SyntheticBoard(args.forums, args.posts)
+    server = xenforo_mock.start(board, latency=args.latency / 1000.0,
+                                rate_limit=args.rate_limit, retry_after=0)
+    spool = tempfile.mkdtemp(prefix='papercut-bench-')
+    configure('http://127.0.0.1:%d/api' % server.server_address[1], spool, args)
+    print("%d forums, %d threads, %d posts, spool %s" % (
+        len(board.forums), len(board.threads), board.next_post_id - 1, spool))
+
+    try:
+        storage, elapsed = timed('full crawl', server, xenforo_api.Papercut_Storage)
+        print("%-22s %9.0f posts/s" % ('', (board.next_post_id - 1) / elapsed))
+        timed('no-op sync', server, storage.xn.sync)
+        board.grow(args.grow)
+        timed('sync of %d posts' % args.grow, server, storage.xn.sync)
+        # edits only show on pages that get fetched for other reasons
+        board.edit(args.edit)
+        board.delete(args.delete)
+        timed('sync of %d deletions' % args.delete, server, storage.xn.sync)
+        timed('compaction', server, storage.xn.compact)
+        storage, elapsed = timed('restart', server, restart)
+
+        lines, elapsed = timed('XOVER', server, xover, storage, args.xover_size)
+        print("%-22s %9.0f lines/s" % ('', lines / elapsed))
+        size, elapsed = timed('BODY x%d' % args.bodies, server, bodies, storage, args.bodies)
+        print("%-22s %9.0f bodies/s, %d bytes" % ('', args.bodies / elapsed, size))
+        print("%d requests answered with 429" % server.stats['rate_limited'])
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(spool)
+
+
+if __name__ == '__main__':
+    main()
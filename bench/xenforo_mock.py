@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 Johannes Grassler. See the LICENSE file for more information.
+#
+# A stand-in for the XenForo REST API, serving a synthetic board of
+# configurable size so the XenForo backend can be exercised and benchmarked
+# without a live forum. Implements the endpoints the backend uses:
+#
+#   GET /nodes/flattened
+#   GET /forums/{id}?page=N&with_threads=1
+#   GET /threads/{id}
+#   GET /threads/{id}/posts?page=N
+#   GET /posts/{id}
+#   GET /attachments/{id}
+#   GET /attachments/{id}/data
+#
+# plus POST /_mock/grow?posts=N, which adds N posts (and the odd new thread),
+# /_mock/edit?posts=N and /_mock/delete?posts=N, which edit and delete
+# random posts, and /_mock/remove?threads=N, which deletes random threads,
+# to simulate activity between syncs. Responses can be delayed and a share of
+# them answered with 429 to exercise the backend's retries. Everything is
+# generated from the seed, so runs are reproducible; post bodies are built on
+# request, so large boards only cost a few bytes per thread.
+#
+# Usage: python bench/xenforo_mock.py [--port N] [--forums N] [--posts N]
+#            [--latency MS] [--rate-limit FRACTION] [--retry-after SECONDS]
+#
+# Then point xenforo_api_url at http://127.0.0.1:PORT/api
+
+import argparse
+import bisect
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ('indy', 'octane', 'irix', 'mips', 'r10000', 'crimson', 'onyx',
+         'fuel', 'tezro', 'scsi', 'nekoware', 'the', 'a', 'of', 'and', 'to',
+         'with', 'boot', 'prom', 'graphics', 'board', 'memory', 'quote',
+         'compiler', 'mipspro', 'gcc', 'patch', 'kernel', 'disk', 'tape')
+
+# seconds between consecutive posts
+POST_INTERVAL = 37
+PER_PAGE = 20
+
+
+class SyntheticBoard:
+    '''
+    A board of forums, threads and posts. Post IDs are handed out
+    thread by thread, so a thread's initial posts are the ID range
+    first..first+count; posts added later are listed per thread.
+    '''
+
+    def __init__(self, forums=10, posts=100000, seed=1, start=1000000000):
+        self.seed = seed
+        self.start = start
+        self.lock = threading.Lock()
+        rng = random.Random(seed)
+        self.forums = []
+        for i in range(forums):
+            self.forums.append({
+                'node_id': i + 2,
+                'title': 'Forum %d %s' % (i + 1, rng.choice(WORDS).title()),
+                'description': 'All about %s and %s' % (rng.choice(WORDS), rng.choice(WORDS)),
+            })
+        # per thread: node ID, title, first post ID, number of initial posts
+        # and the IDs of posts added later
+        self.threads = []
+        self.thread_firsts = []
+        self.extra = {}
+        post_id = 1
+        while post_id <= posts:
+            count = min(int(rng.paretovariate(1.2)) * 3 - 2, 500, posts - post_id + 1)
+            self.add_thread(rng.choice(self.forums)['node_id'], post_id, max(count, 1), rng)
+            post_id += max(count, 1)
+        self.next_post_id = post_id
+        self.sorted_threads = {}
+        # post ID to edit date, and the IDs of deleted posts
+        self.edits = {}
+        self.deleted = set()
+
+    def add_thread(self, node_id, first, count, rng):
+        self.thread_firsts.append(first)
+        self.threads.append({
+            'node_id': node_id,
+            'title': ' '.join(rng.choice(WORDS) for i in range(rng.randint(2, 7))).capitalize(),
+            'first': first,
+            'count': count,
+            'added': [],
+            'deleted': 0,
+        })
+
+    def grow(self, posts):
+        '''Adds posts to random threads, one in ten starting a new thread'''
+        with self.lock:
+            rng = random.Random(self.seed + self.next_post_id)
+            for i in range(posts):
+                post_id = self.next_post_id
+                self.next_post_id += 1
+                if rng.random() < 0.1:
+                    self.add_thread(rng.choice(self.forums)['node_id'], post_id, 1, rng)
+                else:
+                    thread_id = rng.randrange(len(self.threads)) + 1
+                    self.threads[thread_id - 1]['added'].append(post_id)
+                    self.extra[post_id] = thread_id
+            self.sorted_threads = {}
+
+    def edit(self, posts):
+        '''Edits random posts'''
+        with self.lock:
+            rng = random.Random(self.seed + self.next_post_id + len(self.edits))
+            for i in range(posts):
+                post_id = rng.randrange(1, self.next_post_id)
+                self.edits[post_id] = self.post_date(self.next_post_id) + i
+
+    def delete(self, posts):
+        '''Deletes random replies, i.e. posts other than the first in a thread'''
+        with self.lock:
+            rng = random.Random(self.seed + self.next_post_id + len(self.deleted))
+            for i in range(posts * 10):
+                post_id = rng.randrange(1, self.next_post_id)
+                thread_id = self.thread_of(post_id)
+                if self.threads[thread_id - 1]['first'] != post_id and post_id not in self.deleted:
+                    self.deleted.add(post_id)
+                    self.threads[thread_id - 1]['deleted'] += 1
+                    posts -= 1
+                    if posts == 0:
+                        break
+            self.sorted_threads = {}
+
+    def remove(self, threads):
+        '''Deletes random threads; they drop out of their forum's listing'''
+        with self.lock:
+            rng = random.Random(self.seed + self.next_post_id + len(self.threads))
+            while threads > 0:
+                thread = self.threads[rng.randrange(len(self.threads))]
+                if thread['node_id'] is not None:
+                    thread['node_id'] = None
+                    threads -= 1
+            self.sorted_threads = {}
+
+    def post_date(self, post_id):
+        return self.start + post_id * POST_INTERVAL
+
+    def thread_of(self, post_id):
+        if post_id in self.extra:
+            return self.extra[post_id]
+        return bisect.bisect_right(self.thread_firsts, post_id)
+
+    def thread_post_ids(self, thread_id):
+        thread = self.threads[thread_id - 1]
+        post_ids = list(range(thread['first'], thread['first'] + thread['count'])) + thread['added']
+        if thread['deleted']:
+            post_ids = [post_id for post_id in post_ids if post_id not in self.deleted]
+        return post_ids
+
+    def post_count(self, thread_id):
+        thread = self.threads[thread_id - 1]
+        return thread['count'] + len(thread['added']) - thread['deleted']
+
+    def last_post_id(self, thread_id):
+        thread = self.threads[thread_id - 1]
+        if thread['deleted']:
+            return self.thread_post_ids(thread_id)[-1]
+        if thread['added']:
+            return thread['added'][-1]
+        return thread['first'] + thread['count'] - 1
+
+    def thread(self, thread_id):
+        thread = self.threads[thread_id - 1]
+        last = self.last_post_id(thread_id)
+        return {
+            'thread_id': thread_id,
+            'node_id': thread['node_id'],
+            'title': thread['title'],
+            'username': self.username(thread['first']),
+            'reply_count': self.post_count(thread_id) - 1,
+            'view_count': thread['count'] * 13,
+            'post_date': self.post_date(thread['first']),
+            'first_post_id': thread['first'],
+            'last_post_id': last,
+            'last_post_date': self.post_date(last),
+            'discussion_state': 'visible',
+            'sticky': False,
+        }
+
+    def username(self, post_id):
+        return 'user%d' % (random.Random(self.seed * 7 + post_id).randrange(2000))
+
+    def message(self, post_id):
+        '''A few paragraphs with a realistic mix of bbcode'''
+        rng = random.Random(self.seed * 13 + post_id)
+        paragraphs = []
+        for i in range(rng.randint(1, 6)):
+            words = [rng.choice(WORDS) for j in range(rng.randint(8, 60))]
+            kind = rng.random()
+            if kind < 0.15:
+                words[0] = '[b]%s[/b]' % words[0]
+            elif kind < 0.25:
+                words[-1] = '[i]%s[/i]' % words[-1]
+            elif kind < 0.35:
+                words.append('[url=https://example.com/%s]%s[/url]' % (rng.choice(WORDS), rng.choice(WORDS)))
+            elif kind < 0.45:
+                words = ['[quote]'] + words + ['[/quote]']
+            elif kind < 0.5:
+                words = ['[code]'] + words + ['[/code]']
+            elif kind < 0.55:
+                words = ['[list]'] + ['[*]%s' % word for word in words[:5]] + ['[/list]']
+            elif kind < 0.58:
+                words.append('[img]https://example.com/%d.jpg[/img]' % post_id)
+            elif kind < 0.6:
+                words.append('[media=youtube]%08x[/media]' % post_id)
+            paragraphs.append(' '.join(words))
+        if post_id in self.edits:
+            paragraphs.append('[i]Edited %d[/i]' % self.edits[post_id])
+        return '\n\n'.join(paragraphs)
+
+    def attachment(self, attachment_id):
+        '''Every 40th post has an attachment, with the post's ID'''
+        if attachment_id % 40 != 0 or attachment_id >= self.next_post_id:
+            return None
+        return {
+            'attachment_id': attachment_id,
+            'content_type': 'post',
+            'content_id': attachment_id,
+            'attach_date': self.post_date(attachment_id),
+            'filename': 'file%d.jpg' % attachment_id,
+            'file_size': random.Random(attachment_id).randint(1000, 200000),
+            'view_count': 0,
+        }
+
+    def attachment_data(self, attachment_id):
+        attachment = self.attachment(attachment_id)
+        return random.Random(attachment_id).randbytes(attachment['file_size'])
+
+    def post(self, post_id, thread_id=None, position=None):
+        if thread_id is None:
+            thread_id = self.thread_of(post_id)
+        thread = self.threads[thread_id - 1]
+        post = {
+            'post_id': post_id,
+            'thread_id': thread_id,
+            'user_id': int(self.username(post_id)[4:]) + 1,
+            'username': self.username(post_id),
+            'post_date': self.post_date(post_id),
+            'message': self.message(post_id),
+            'message_state': 'visible',
+            'position': position,
+            'is_first_post': post_id == thread['first'],
+            'last_edit_date': self.edits.get(post_id, 0),
+            'reaction_score': 0,
+            'attach_count': 0,
+        }
+        attachment = self.attachment(post_id)
+        if attachment is not None:
+            post['attach_count'] = 1
+            post['Attachments'] = [attachment]
+        return post
+
+    def forum_threads(self, node_id):
+        '''Thread IDs of a forum, most recently active first'''
+        with self.lock:
+            if node_id not in self.sorted_threads:
+                threads = [index + 1 for index, thread in enumerate(self.threads)
+                           if thread['node_id'] == node_id]
+                threads.sort(key=self.last_post_id, reverse=True)
+                self.sorted_threads[node_id] = threads
+            return self.sorted_threads[node_id]
+
+    def nodes(self):
+        nodes = [{'node': {'node_id': 1, 'title': 'Main category', 'description': '',
+                           'node_type_id': 'Category', 'type_data': {}}, 'depth': 0}]
+        for forum in self.forums:
+            threads = self.forum_threads(forum['node_id'])
+            type_data = {'discussion_count': len(threads), 'message_count': 0,
+                         'last_post_id': 0, 'last_post_date': 0}
+            if threads:
+                last = self.thread(threads[0])
+                type_data.update(last_post_id=last['last_post_id'],
+                                 last_post_date=last['last_post_date'],
+                                 last_thread_id=last['thread_id'],
+                                 last_thread_title=last['title'],
+                                 message_count=sum(self.post_count(t) for t in threads))
+            nodes.append({'node': dict(forum, node_type_id='Forum', type_data=type_data), 'depth': 1})
+        return nodes
+
+
+def webhook(content_type, event, content_id, data):
+    return {'content_type': content_type, 'event': event, 'content_id': content_id, 'data': data}
+
+
+def webhook_payloads(board, edit=0, grow=0, delete=0, remove=0):
+    '''
+    Makes the changes the /_mock endpoints make to board and returns the
+    webhook payloads XenForo would send for them. Each batch starts with
+    a {'_mock': change, ...} entry, so a replay can make the same change
+    to a mock serving a board generated with the same arguments.
+    '''
+    payloads = []
+    # editing first: edit() and delete() pick the same posts for the same
+    # board size
+    if edit:
+        payloads.append({'_mock': 'edit', 'posts': edit})
+        edits = dict(board.edits)
+        board.edit(edit)
+        for post_id in sorted(board.edits):
+            if board.edits[post_id] != edits.get(post_id) and post_id not in board.deleted:
+                payloads.append(webhook('post', 'update', post_id, board.post(post_id)))
+    if grow:
+        payloads.append({'_mock': 'grow', 'posts': grow})
+        first, threads = board.next_post_id, len(board.threads)
+        board.grow(grow)
+        for post_id in range(first, board.next_post_id):
+            thread_id = board.thread_of(post_id)
+            data = board.post(post_id, thread_id, board.thread_post_ids(thread_id).index(post_id))
+            if thread_id > threads:
+                # a new thread comes as the thread and its first post
+                data['Thread'] = board.thread(thread_id)
+                payloads.append(webhook('thread', 'insert', thread_id, data['Thread']))
+            payloads.append(webhook('post', 'insert', post_id, data))
+    if delete:
+        payloads.append({'_mock': 'delete', 'posts': delete})
+        deleted = set(board.deleted)
+        board.delete(delete)
+        for post_id in sorted(board.deleted - deleted):
+            payloads.append(webhook('post', 'delete', post_id, board.post(post_id)))
+    if remove:
+        payloads.append({'_mock': 'remove', 'threads': remove})
+        nodes = [thread['node_id'] for thread in board.threads]
+        board.remove(remove)
+        for index, thread in enumerate(board.threads):
+            if thread['node_id'] is None and nodes[index] is not None:
+                data = dict(board.thread(index + 1), node_id=nodes[index])
+                payloads.append(webhook('thread', 'delete', index + 1, data))
+    return payloads
+
+
+def paginate(items, page):
+    last_page = max(1, (len(items) + PER_PAGE - 1) // PER_PAGE)
+    return (items[(page - 1) * PER_PAGE:page * PER_PAGE],
+            {'current_page': page, 'last_page': last_page, 'per_page': PER_PAGE,
+             'shown': len(items[(page - 1) * PER_PAGE:page * PER_PAGE]), 'total': len(items)})
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, data, headers={}):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parse(self):
+        path = self.path
+        # the backend appends its parameters with & rather than ?
+        if '?' not in path and '&' in path:
+            path = path.replace('&', '?', 1)
+        url = urllib.parse.urlsplit(path)
+        parts = [part for part in url.path.split('/') if part]
+        if parts and parts[0] == 'api':
+            parts = parts[1:]
+        query = dict(urllib.parse.parse_qsl(url.query))
+        return parts, query
+
+    def throttle(self):
+        '''Applies the configured latency and rate limiting, True if limited'''
+        server = self.server
+        with server.stats_lock:
+            server.stats['requests'] += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.rate_limit and server.rng.random() < server.rate_limit:
+            with server.stats_lock:
+                server.stats['rate_limited'] += 1
+            self.send_json(429, {'errors': [{'code': 'too_many_requests'}]},
+                           {'Retry-After': str(server.retry_after)})
+            return True
+        return False
+
+    def do_POST(self):
+        parts, query = self.parse()
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if len(parts) == 2 and parts[0] == '_mock' and parts[1] in ('grow', 'edit', 'delete'):
+            getattr(self.server.board, parts[1])(int(query.get('posts', 100)))
+            self.send_json(200, {'next_post_id': self.server.board.next_post_id})
+        elif parts == ['_mock', 'remove']:
+            self.server.board.remove(int(query.get('threads', 1)))
+            self.send_json(200, {'next_post_id': self.server.board.next_post_id})
+        else:
+            self.send_json(404, {'errors': [{'code': 'not_found'}]})
+
+    def do_GET(self):
+        if self.throttle():
+            return
+        board = self.server.board
+        parts, query = self.parse()
+        page = int(query.get('page', 1))
+        try:
+            if parts == ['nodes', 'flattened']:
+                self.send_json(200, {'nodes_flat': board.nodes()})
+            elif len(parts) == 2 and parts[0] == 'forums':
+                node_id = int(parts[1])
+                forum = [forum for forum in board.forums if forum['node_id'] == node_id][0]
+                threads, pagination = paginate(board.forum_threads(node_id), page)
+                self.send_json(200, {'forum': forum,
+                                     'threads': [board.thread(thread_id) for thread_id in threads],
+                                     'pagination': pagination})
+            elif len(parts) == 2 and parts[0] == 'threads':
+                self.send_json(200, {'thread': board.thread(int(parts[1]))})
+            elif len(parts) == 3 and parts[0] == 'threads' and parts[2] == 'posts':
+                thread_id = int(parts[1])
+                post_ids, pagination = paginate(board.thread_post_ids(thread_id), page)
+                offset = (page - 1) * PER_PAGE
+                self.send_json(200, {'thread': board.thread(thread_id),
+                                     'posts': [board.post(post_id, thread_id, offset + index)
+                                               for index, post_id in enumerate(post_ids)],
+                                     'pagination': pagination})
+            elif len(parts) == 2 and parts[0] == 'posts':
+                post_id = int(parts[1])
+                if post_id >= board.next_post_id or post_id in board.deleted:
+                    raise IndexError(post_id)
+                self.send_json(200, {'post': board.post(post_id)})
+            elif len(parts) in (2, 3) and parts[0] == 'attachments':
+                attachment = board.attachment(int(parts[1]))
+                if attachment is None:
+                    raise IndexError(parts[1])
+                if len(parts) == 2:
+                    self.send_json(200, {'attachment': attachment})
+                else:
+                    data = board.attachment_data(int(parts[1]))
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+            else:
+                raise IndexError(self.path)
+        except (IndexError, ValueError):
+            self.send_json(404, {'errors': [{'code': 'not_found'}]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(board, port=0, latency=0.0, rate_limit=0.0, retry_after=0, seed=1):
+    '''
+    Serves board on a daemon thread and returns the server; its port is
+    server.server_address[1], its request counters server.stats
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockHandler)
+    server.daemon_threads = True
+    server.board = board
+    server.latency = latency
+    server.rate_limit = rate_limit
+    server.retry_after = retry_after
+    server.rng = random.Random(seed)
+    server.stats = {'requests': 0, 'rate_limited': 0}
+    server.stats_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, name='xenforo-mock', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock XenForo API serving a synthetic board')
+    parser.add_argument('--port', type=int, default=8118)
+    parser.add_argument('--forums', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to each request')
+    parser.add_argument('--rate-limit', type=float, default=0, help='share of requests answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    started = time.time()
+    board = SyntheticBoard(args.forums, args.posts, args.seed)
+    print("generated %d forums, %d threads, %d posts in %.1fs" % (
+        len(board.forums), len(board.threads), board.next_post_id - 1, time.time() - started))
+    server = start(board, args.port, args.latency / 1000.0, args.rate_limit, args.retry_after, args.seed)
+    print("serving on http://127.0.0.1:%d/api" % server.server_address[1])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 Johannes Grassler. See the LICENSE file for more information.
+#
+# Records the webhook payloads for a batch of changes to the synthetic board
+# of bench/xenforo_mock.py: new posts and threads, edits, deleted posts and
+# deleted threads, one JSON object per line, for
+# bench/xenforo_webhook_replay.py. The board arguments have to match those
+# of the mock the payloads are replayed against.
+# bench/xenforo_webhooks.jsonl was recorded with the defaults.
+#
+# Usage: python bench/xenforo_webhook_record.py PAYLOADS [--forums N]
+#            [--posts N] [--seed N] [--grow N] [--edit N] [--delete N]
+#            [--remove N]
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import xenforo_mock
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record XenForo webhook payloads for the mock board')
+    parser.add_argument('payloads', help='file to write one JSON payload per line to')
+    parser.add_argument('--forums', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--grow', type=int, default=20, help='posts to add')
+    parser.add_argument('--edit', type=int, default=10, help='posts to edit')
+    parser.add_argument('--delete', type=int, default=10, help='posts to delete')
+    parser.add_argument('--remove', type=int, default=2, help='threads to delete')
+    args = parser.parse_args()
+
+    board = xenforo_mock.SyntheticBoard(args.forums, args.posts, args.seed)
+    payloads = xenforo_mock.webhook_payloads(board, args.edit, args.grow, args.delete, args.remove)
+    with open(args.payloads, 'w') as f:
+        for payload in payloads:
+            f.write(json.dumps(payload) + '\n')
+    print("recorded %d payloads" % sum(1 for payload in payloads if '_mock' not in payload))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 Johannes Grassler. See the LICENSE file for more information.
+#
+# Stands in for XenForo when testing the webhook listener of the XenForo
+# backend: posts recorded webhook payloads, one JSON object per line, to the
+# listener and prints the status it answers each of them with.
+#
+# bench/xenforo_webhooks.jsonl holds payloads recorded for the default board
+# of bench/xenforo_mock.py (see bench/xenforo_webhook_record.py). Lines with
+# a _mock key name the change to the board the payloads after them are for;
+# with --mock, the change is made to the mock as well, so a later sync finds
+# the board as the webhooks described it. Without, they are skipped.
+#
+# Usage: python bench/xenforo_webhook_replay.py PAYLOADS [--url URL]
+#            [--secret SECRET] [--mock URL]
+
+import argparse
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+def change_mock(mock, payload):
+    '''Makes the change a _mock line names to the mock's board'''
+    query = urllib.parse.urlencode(dict((key, value) for key, value in payload.items() if key != '_mock'))
+    request = urllib.request.Request('%s/_mock/%s?%s' % (mock.rstrip('/'), payload['_mock'], query),
+                                     data=b'', method='POST')
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    print("mock %s %s" % (payload['_mock'], query))
+
+
+def replay(url, secret, payloads, mock=None):
+    for line in payloads:
+        line = line.strip()
+        if not line:
+            continue
+        payload = json.loads(line)
+        if '_mock' in payload:
+            if mock:
+                change_mock(mock, payload)
+            continue
+        request = urllib.request.Request(url, data=line.encode('utf-8'), method='POST',
+                                         headers={'Content-Type': 'application/json',
+                                                  'XF-Webhook-Secret': secret})
+        start = time.time()
+        try:
+            with urllib.request.urlopen(request) as response:
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        print("%s %s %s: %d (%.1fms)" % (payload.get('content_type'), payload.get('event'),
+                                         payload.get('content_id'), status,
+                                         (time.time() - start) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded XenForo webhook payloads')
+    parser.add_argument('payloads', help='file with one JSON payload per line')
+    parser.add_argument('--url', default='http://127.0.0.1:8119/')
+    parser.add_argument('--secret', default='')
+    parser.add_argument('--mock', default=None,
+                        help='URL of the mock API (e.g. http://127.0.0.1:8118/api) to make the changes on')
+    args = parser.parse_args()
+    with open(args.payloads) as f:
+        replay(args.url, args.secret, f, args.mock)
+
+
+if __name__ == '__main__':
+    main()
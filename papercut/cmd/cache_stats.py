@@ -0,0 +1,28 @@
+# Copyright (c) 2016 Johannes Grassler. See the LICENSE file for more information.
+import sys
+
+import papercut.settings
+import papercut.papercut_cache as papercut_cache
+
+settings = papercut.settings.CONF()
+
+# Prints the cache statistics a running (or stopped) papercut server
+# periodically writes to its cache directories, one line per cached method.
+
+def main():
+  policies = [papercut_cache.get_policy()]
+  if isinstance(settings.hierarchies, dict):
+    for h in settings.hierarchies:
+      policies.append(papercut_cache.get_policy(settings.hierarchies[h], h))
+
+  found = False
+  for policy in policies:
+    data = papercut_cache.load_stats(policy.path)
+    if data is None:
+      continue
+    found = True
+    for line in papercut_cache.format_stats(policy.namespace, data):
+      print(line)
+
+  if not found:
+    sys.exit('No cache statistics found below %s' % settings.nntp_cache_path)
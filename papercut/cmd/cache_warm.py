@@ -0,0 +1,75 @@
+# Copyright (c) 2016 Johannes Grassler. See the LICENSE file for more information.
+import socket
+import sys
+
+import papercut.settings
+
+settings = papercut.settings.CONF()
+
+# Has a running papercut server warm its caches (see nntp_cache_warm in
+# settings.py for what gets fetched) and prints its report, one line per
+# group.
+#
+# The server does the warming itself, through the XWARM command: loading a
+# second set of backends here would run their own syncs (and for XenForo
+# their own webhook listener) and write to the same spool as the server's.
+
+
+class Client:
+  '''Just enough of an NNTP client to send a command and read its response'''
+
+  def __init__(self, host, port):
+    self.sock = socket.create_connection((host, port))
+    self.file = self.sock.makefile('rb')
+    self.response()
+
+  def response(self):
+    '''Reads a status line, raises IOError for anything but 1xx-3xx'''
+    line = self.file.readline()
+    if not line:
+      raise IOError('connection closed')
+    line = line.decode('latin-1').rstrip('\r\n')
+    if line[:1] not in ('1', '2', '3'):
+      raise IOError(line)
+    return line
+
+  def command(self, line, multiline=False):
+    '''Sends a command, returns its status line and, if multiline, the lines up to the lone "."'''
+    self.sock.sendall(line.encode('latin-1') + b'\r\n')
+    status = self.response()
+    lines = []
+    while multiline:
+      line = self.file.readline()
+      if not line:
+        raise IOError('connection closed')
+      line = line.decode('latin-1').rstrip('\r\n')
+      if line == '.':
+        break
+      # undo the dot-stuffing
+      if line.startswith('..'):
+        line = line[1:]
+      lines.append(line)
+    return status, lines
+
+  def close(self):
+    try:
+      self.command('QUIT')
+    except IOError:
+      pass
+    self.file.close()
+    self.sock.close()
+
+
+def main():
+  opts = papercut.settings.OPTS()
+  try:
+    client = Client(settings.nntp_hostname, settings.nntp_port)
+    if opts.user:
+      client.command('AUTHINFO USER %s' % opts.user)
+      client.command('AUTHINFO PASS %s' % opts.password)
+    status, lines = client.command('XWARM', multiline=True)
+  except (OSError, IOError) as e:
+    sys.exit('Cache warm-up through papercut at %s:%s failed: %s' % (settings.nntp_hostname, settings.nntp_port, e))
+  for line in lines:
+    print(line)
+  client.close()
@@ -10,6 +10,7 @@ import signal
 import time
 import re
 import email.message as rfc822
+import threading
 import traceback
 import io
 
@@ -75,6 +76,8 @@ STATUS_AUTH_REQUIRED = '480 Authentication required'
 STATUS_AUTH_ACCEPTED = '281 Authentication accepted'
 STATUS_AUTH_CONTINUE = '381 More authentication information required'
 STATUS_SERVER_VERSION = '200 Papercut %s' % (__VERSION__)
+STATUS_XSTATS = '215 cache statistics follow'
+STATUS_XWARM = '215 cache warm-up report follows'
 
 # the currently supported overview headers
 overview_headers = ('Subject:', 'From:', 'Date:', 'Message-ID:', 'References:', 'Bytes:', 'Lines:', 'Xref:full')
@@ -114,26 +117,60 @@ def list_backends():
   return backend_map
 
 
-# Get list of backends from configuration
-backends = list_backends()
-
-# Load all backends and make them accessible by hierarchy
-for h in backends:
-  # dynamic loading of the appropriate storage backend module
-  temp = __import__('papercut.storage.%s' % (backends[h]), globals(), locals(), ['Papercut_Storage'])
-  backend=None
-  # papercut. is a reserved hierarchy for global backends
-  if h == 'sgug':
-    # Cache only works for parameterless Papercut_Storage constructors so
-    # let's restrict it to the global backend for now.
-    if settings.nntp_cache == 'yes':
-      backend = papercut_cache.Cache(temp, papercut_cache.cache_methods)
+def load_backends():
+  '''
+  Loads all backends and returns a dict making them accessible by hierarchy
+  '''
+  # Get list of backends from configuration
+  backends = list_backends()
+
+  for h in backends:
+    # dynamic loading of the appropriate storage backend module
+    temp = __import__('papercut.storage.%s' % (backends[h]), globals(), locals(), ['Papercut_Storage'])
+    backend=None
+    # papercut. is a reserved hierarchy for global backends
+    if h == 'sgug':
+      args = ()
+      local_settings = {}
+      namespace = ''
+    # All other hierarchies get configuration from the hierarchies dict
     else:
-      backend = temp.Papercut_Storage()
-  # All other hierarchies get configuration from the hierarchies dict
-  else:
-    backend = temp.Papercut_Storage(h, settings.hierarchies[h])
-  backends[h] = backend
+      args = (h, settings.hierarchies[h])
+      local_settings = settings.hierarchies[h]
+      namespace = h
+    if local_settings.get('nntp_cache', settings.nntp_cache) == 'yes':
+      policy = papercut_cache.get_policy(local_settings, namespace)
+      backend = papercut_cache.Cache(temp, policy, *args)
+    else:
+      backend = temp.Papercut_Storage(*args)
+    backends[h] = backend
+
+  return backends
+
+
+def warm_backends(output=print):
+  '''
+  Warms the caches of all cached backends, passing a line with the time
+  taken per group to output
+  '''
+  def report(group_name, seconds, error):
+    if error:
+      output('cache warm-up: %s failed: %s' % (group_name, error))
+    else:
+      output('cache warm-up: %s warmed in %.3fs' % (group_name, seconds))
+
+  for h in backends:
+    if not isinstance(backends[h], papercut_cache.Cache):
+      continue
+    start = time.time()
+    count = papercut_cache.warm(backends[h],
+                                settings.nntp_cache_warm_concurrency,
+                                settings.nntp_cache_warm_xover,
+                                report)
+    output('cache warm-up: %s: %d groups in %.3fs' % (h, count, time.time() - start))
+
+
+backends = load_backends()
 
 # load authentication module, if needed
 if settings.nntp_auth == 'yes':
@@ -153,12 +190,12 @@ class NNTPRequestHandler(socketserver.StreamRequestHandler):
                 'SLAVE', 'DATE', 'IHAVE',
                 'OVER', 'HDR', 'AUTHINFO',
                 'CAPABILITIES',
-                'XROVER', 'XVERSION')
+                'XROVER', 'XVERSION', 'XSTATS', 'XWARM')
     # this is the list of list of extensions supported that are obviously not in the official NNTP document
     extensions = ('XOVER', 'XPAT', 'LISTGROUP',
                   'XGTITLE', 'XHDR', 'MODE',
                   'OVER', 'HDR', 'AUTHINFO',
-                  'XROVER', 'XVERSION')
+                  'XROVER', 'XVERSION', 'XSTATS', 'XWARM')
     terminated = 0
     selected_article = 'ggg'
     selected_group = 'ggg'
@@ -274,16 +311,16 @@ READER
             ts = self.get_timestamp(self.tokens[1], self.tokens[2], 'yes')
         else:
             ts = self.get_timestamp(self.tokens[1], self.tokens[2], 'no')
-        allgroups = None
+        allgroups = []
         for backend in list(backends.values()):
           groups = backend.get_NEWGROUPS(ts)
-          if groups is not None:
-            allgroups += groups
+          if groups:
+            allgroups.append(groups)
 
-        if allgroups == None:
+        if len(allgroups) == 0:
             msg = "%s\r\n." % (STATUS_NEWGROUPS)
         else:
-            msg = "%s\r\n%s\r\n." % (STATUS_NEWGROUPS, allgroups)
+            msg = "%s\r\n%s\r\n." % (STATUS_NEWGROUPS, "\r\n".join(allgroups))
         self.send_response(msg)
 
     def do_GROUP(self):
@@ -351,13 +388,14 @@ READER
         Calls newnews for all for group_backend if we already know where to
         look and for all of them otherwise.
         '''
-        news = ''
         if group_backend:
-          news = group_backend.get_NEWNEWS(timestamp, param)
-        else:
-          for backend in list(backends.values()):
-            news += backend.get_NEWNEWS(timestamp, param)
-        return news
+          return group_backend.get_NEWNEWS(timestamp, param)
+        news = []
+        for backend in list(backends.values()):
+          backend_news = backend.get_NEWNEWS(timestamp, param)
+          if backend_news:
+            news.append(backend_news)
+        return "\r\n".join(news)
 
 
 
@@ -536,7 +574,10 @@ READER
                 response = STATUS_ARTICLE % (0, self.tokens[1])
             else:
                 response = STATUS_ARTICLE % (article_info[0], backend.get_message_id(article_info[1], article_info[0]))
-            self.send_response("%s\r\n%s\r\n\r\n%s\r\n." % (response, result[0], result[1]))
+            if isinstance(result[1], str):
+                self.send_response("%s\r\n%s\r\n\r\n%s\r\n." % (response, result[0], result[1]))
+            else:
+                self.send_response_stream("%s\r\n%s\r\n" % (response, result[0]), result[1])
 
 
     def do_LAST(self):
@@ -628,9 +669,13 @@ READER
             self.send_response(ERR_NOSUCHARTICLENUM)
         else:
             if self.tokens[1][0] == '<':
-                self.send_response("%s\r\n%s\r\n." % (STATUS_HEAD % ('0', self.tokens[1]), body))
+                response = STATUS_HEAD % ('0', self.tokens[1])
+            else:
+                response = STATUS_BODY % (article_info[1], backend.get_message_id(article_info[1], article_info[0]))
+            if isinstance(body, str):
+                self.send_response("%s\r\n%s\r\n." % (response, body))
             else:
-                self.send_response("%s\r\n%s\r\n." % (STATUS_BODY % (article_info[1], backend.get_message_id(article_info[1], article_info[0])), body))
+                self.send_response_stream(response, body)
 
 
     def do_HEAD(self):
@@ -745,6 +790,7 @@ READER
         if not self.index_in_list(overview_headers, self.tokens[1]):
             self.send_response("%s\r\n." % (STATUS_XPAT))
             return
+        backend = self._backend_from_group(self.selected_group)
         if self.tokens[2].find('@') != -1:
             self.tokens[2] = self.get_number_from_msg_id(self.tokens[2])
             self.do_XHDR()
@@ -763,7 +809,7 @@ READER
     def do_LISTGROUP(self):
         """
         Syntax:
-            LISTGROUP [ggg]
+            LISTGROUP [ggg [range]]
         Responses:
             211 list of article numbers follow
             411 No such group
@@ -771,49 +817,73 @@ READER
             502 no permission
         """
         backend = None
-        if len(self.tokens) > 2:
+        if len(self.tokens) > 3:
             self.send_response(ERR_CMDSYNTAXERROR)
             return
-        if len(self.tokens) == 2:
+        start = end = None
+        if len(self.tokens) == 3:
+            # RFC 3977 ranges: n, n- or n-m
+            match = re.match(r'^([0-9]+)(-([0-9]*))?$', self.tokens[2])
+            if match is None:
+                self.send_response(ERR_CMDSYNTAXERROR)
+                return
+            start = int(match.group(1))
+            if match.group(2) is None:
+                end = start
+            elif match.group(3):
+                end = int(match.group(3))
+        if len(self.tokens) >= 2:
             backend = self._backend_from_group(self.tokens[1])
             # check if the group exists
             if not backend or not backend.group_exists(self.tokens[1]):
                 # the draft of the new NNTP protocol tell us to reply this instead of an empty list
                 self.send_response(ERR_NOSUCHGROUP)
                 return
-            try:
-              numbers = backend.get_LISTGROUP(self.tokens[1])
-            # TODO: Introduce a dedicated exception for this kind of thing -
-            # depending on the plugin this might be a ENOENT or a database
-            # exception.
-            except KeyError:
-              self.send_response(ERR_NOSUCHGROUP)
-              return
+            group = self.tokens[1]
         else:
             if self.selected_group == 'ggg':
                 self.send_response(ERR_NOGROUPSELECTED)
                 return
             backend = self._backend_from_group(self.selected_group)
-            try:
-              numbers = backend.get_LISTGROUP(self.selected_group)
-            # TODO: Introduce a dedicated exception for this kind of thing -
-            # depending on the plugin this might be a ENOENT or a database
-            # exception.
-            except KeyError:
-              self.send_response(ERR_NOSUCHGROUP)
-              return
-        check = numbers.split('\r\n') 
-        if len(check) > 0:
-            # When a valid group is selected by means of this command, the
-            # internally maintained "current article pointer" is set to the first
-            # article in the group.
-            self.selected_article = check[0]
-            if len(self.tokens) == 2:
-                self.selected_group = self.tokens[1]
+            group = self.selected_group
+        try:
+            numbers = self._listgroup(backend, group, start, end)
+        # TODO: Introduce a dedicated exception for this kind of thing -
+        # depending on the plugin this might be a ENOENT or a database
+        # exception.
+        except KeyError:
+            self.send_response(ERR_NOSUCHGROUP)
+            return
+        stats = backend.get_group_stats(group)
+        # When a valid group is selected by means of this command, the
+        # internally maintained "current article pointer" is set to the first
+        # article in the group. If an empty newsgroup is selected, the
+        # current article pointer is made invalid.
+        if stats[0] > 0:
+            self.selected_article = str(stats[1])
         else:
-            # If an empty newsgroup is selected, the current article pointer is made invalid.
             self.selected_article = 'ggg'
-        self.send_response("%s\r\n%s\r\n." % (STATUS_LISTGROUP % (backend.get_group_stats(self.selected_group)), numbers))
+        self.selected_group = group
+        if not isinstance(numbers, str):
+            self.send_response_stream(STATUS_LISTGROUP % stats, numbers)
+        elif len(numbers) == 0:
+            self.send_response("%s\r\n." % (STATUS_LISTGROUP % stats))
+        else:
+            self.send_response("%s\r\n%s\r\n." % (STATUS_LISTGROUP % stats, numbers))
+
+    def _listgroup(self, backend, group, start, end):
+        '''
+        Returns a group's article numbers from start to end (None for no
+        limit). Backends that don't set listgroup_range to say they take a
+        range get their list filtered.
+        '''
+        if start is None:
+            return backend.get_LISTGROUP(group)
+        if getattr(backend, 'listgroup_range', False):
+            return backend.get_LISTGROUP(group, start, end)
+        numbers = [number for number in backend.get_LISTGROUP(group).split('\r\n')
+                   if number and int(number) >= start and (end is None or int(number) <= end)]
+        return "\r\n".join(numbers)
 
     def do_XGTITLE(self):
         """
@@ -827,11 +897,18 @@ READER
             self.send_response(ERR_CMDSYNTAXERROR)
             return
         if len(self.tokens) == 2:
-            info = backend.get_XGTITLE(self.tokens[1])
+            # the wildmat may match groups of any backend
+            infos = [backend.get_XGTITLE(self.tokens[1]) for backend in list(backends.values())]
+            infos = [backend_info for backend_info in infos if backend_info is not None]
+            if len(infos) == 0:
+                info = None
+            else:
+                info = "\r\n".join(backend_info for backend_info in infos if backend_info)
         else:
             if self.selected_group == 'ggg':
                 self.send_response(ERR_NOGROUPSELECTED)
                 return
+            backend = self._backend_from_group(self.selected_group)
             info = backend.get_XGTITLE(self.selected_group)
         if info is None:
             self.send_response(ERR_NODESCAVAILABLE)
@@ -1042,6 +1119,47 @@ READER
     def do_XVERSION(self):
         self.send_response(STATUS_SERVER_VERSION)
 
+    def do_XSTATS(self):
+        """
+        Syntax:
+            XSTATS
+        Responses:
+            215 cache statistics follow
+        """
+        lines = []
+        for hierarchy in backends:
+            if isinstance(backends[hierarchy], papercut_cache.Cache):
+                lines.extend(papercut_cache.format_stats(hierarchy, backends[hierarchy].get_stats()))
+        if len(lines) == 0:
+            self.send_response("%s\r\n." % (STATUS_XSTATS))
+        else:
+            self.send_response("%s\r\n%s\r\n." % (STATUS_XSTATS, "\r\n".join(lines)))
+
+    def do_XWARM(self):
+        """
+        Syntax:
+            XWARM
+        Responses:
+            215 cache warm-up report follows
+            502 no permission
+        """
+        # warming takes a while and loads the backends, so only clients on
+        # this host (papercut_cache_warm) get to ask for it
+        if self.client_address[0] not in ('127.0.0.1', '::1', self.request.getsockname()[0]):
+            self.send_response(ERR_AUTH_NO_PERMISSION)
+            return
+        lines = []
+        lock = threading.Lock()
+
+        def output(line):
+            with lock:
+                lines.append(line)
+        warm_backends(output)
+        if len(lines) == 0:
+            self.send_response("%s\r\n." % (STATUS_XWARM))
+        else:
+            self.send_response("%s\r\n%s\r\n." % (STATUS_XWARM, "\r\n".join(lines)))
+
     def get_number_from_msg_id(self, msg_id, backend):
         '''
         Mangles the message ID by extracting just the local part for backend
@@ -1083,6 +1201,20 @@ READER
         self.wfile.write(bytes(message + "\r\n", 'latin-1', 'replace'))
         self.wfile.flush()
 
+    def send_response_stream(self, message, chunks):
+        '''
+        Sends a multi-line response whose text a backend hands out in chunks
+        (strings of whole lines, each ending in CRLF), as they come, so
+        large bodies never have to be in memory as a whole
+        '''
+        if __DEBUG__:
+            print("server>", message, "(streamed)")
+        self.wfile.write(bytes(message + "\r\n", 'latin-1', 'replace'))
+        for chunk in chunks:
+            self.wfile.write(bytes(chunk, 'latin-1', 'replace'))
+        self.wfile.write(b".\r\n")
+        self.wfile.flush()
+
     def finish(self):
         # cleaning up after ourselves
         self.terminated = 0
@@ -1104,10 +1236,17 @@ def main():
     def sighandler(signum, frame):
         if __DEBUG__: print("\nShutting down papercut...")
         server.socket.close()
+        for backend in list(backends.values()):
+            if isinstance(backend, papercut_cache.Cache):
+                backend.stats.save(force=True)
         time.sleep(1)
         sys.exit(0)
 
     signal.signal(signal.SIGINT, sighandler)
+    # warm up before binding the socket, so clients only connect once the
+    # caches are populated
+    if settings.nntp_cache_warm == 'yes':
+      warm_backends()
     if settings.storage_backend:
       print('Papercut %s (global storage module %s) - starting up' % (__VERSION__, settings.storage_backend))
       server = NNTPServer((settings.nntp_hostname, settings.nntp_port), NNTPRequestHandler)
@@ -1,11 +1,14 @@
 # Copyright (c) 2002 Joao Prado Maia. See the LICENSE file for more information.
 
-import binascii
 from hashlib import md5
 import time
 import os
+import json
+import lzma
 import pickle
-import papercut.portable_locker
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import papercut.settings
 
 settings = papercut.settings.CONF()
@@ -15,76 +18,471 @@ settings = papercut.settings.CONF()
 cache_methods = ('get_XHDR', 'get_XGTITLE', 'get_LISTGROUP',
                  'get_XPAT', 'get_XOVER', 'get_BODY',
                  'get_HEAD', 'get_ARTICLE', 'get_STAT',
-                 'get_LIST')
+                 'get_LIST', 'get_GROUP')
+
+# cached methods taking the group name as their first argument. Their entries
+# are keyed on that group's generation, all others (and lookups by message
+# ID, which may resolve to any group) on the backend wide generation.
+group_methods = ('get_XHDR', 'get_LISTGROUP', 'get_XPAT',
+                 'get_XOVER', 'get_BODY', 'get_HEAD',
+                 'get_ARTICLE', 'get_STAT', 'get_GROUP')
+
+# compression codecs for cache entries: name -> (compress, decompress)
+codecs = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+# name of the file each cache's statistics are periodically written to, and
+# the minimum interval between writes (in seconds)
+stats_file = '.stats'
+stats_interval = 60
+
+# share of the size budget a cache over budget is evicted down to, so it
+# isn't evicting again on the next write
+evict_low_water = 0.9
+
+
+class CachePolicy:
+    '''
+    Cache settings for one backend instance: expiry interval, the methods to
+    cache, the disk budget in bytes (0 means unlimited), the namespace, i.e.
+    the subdirectory of nntp_cache_path the entries are kept in, and the
+    codec for entries larger than compress_threshold bytes.
+    '''
+
+    def __init__(self, expire, methods, size=0, namespace='',
+                 compress='none', compress_threshold=4096):
+        self.expire = expire
+        self.methods = tuple(methods)
+        self.size = size
+        self.namespace = namespace
+        self.path = os.path.join(settings.nntp_cache_path, namespace)
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+
+
+def get_policy(local_settings=None, namespace=''):
+    '''
+    Builds a CachePolicy from the global cache settings, overridden by the
+    nntp_cache_* keys of a hierarchy's configuration block (if any).
+    '''
+    if local_settings is None:
+        local_settings = {}
+
+    def setting(key):
+        if key in local_settings:
+            return local_settings[key]
+        return getattr(settings, key)
+
+    methods = setting('nntp_cache_methods')
+    if methods is None:
+        methods = cache_methods
+    # the global namespace is for the global backend only, falling back on
+    # it would put all hierarchies' entries into one directory
+    if namespace:
+        namespace = local_settings.get('nntp_cache_namespace') or namespace
+    else:
+        namespace = settings.nntp_cache_namespace
+    return CachePolicy(setting('nntp_cache_expire'),
+                       methods,
+                       setting('nntp_cache_size'),
+                       namespace,
+                       setting('nntp_cache_compress'),
+                       setting('nntp_cache_compress_threshold'))
+
+
+def encode_entry(result, codec='none', threshold=0):
+    '''
+    Serializes a cached result. Returns the codec actually used (payloads
+    below threshold are stored uncompressed), the payload and its size
+    before compression.
+    '''
+    payload = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    if codec not in codecs or len(payload) < threshold:
+        return ('none', payload, len(payload))
+    return (codec, codecs[codec][0](payload), len(payload))
+
+
+def decode_entry(codec, payload):
+    if codec != 'none':
+        if codec not in codecs:
+            raise ValueError('unknown codec %r' % (codec,))
+        payload = codecs[codec][1](payload)
+    return pickle.loads(payload)
+
+
+# what reading an entry that is damaged (or was written by an incompatible
+# version) raises; such an entry is treated as a miss and overwritten
+entry_errors = (OSError, EOFError, ValueError, pickle.UnpicklingError,
+                zlib.error, lzma.LZMAError)
+
+
+class CacheStats:
+    '''
+    Counters for one Cache instance, kept per cached method: hits, misses,
+    stale entries (found but expired, so they had to be refreshed), bytes
+    written (before and after compression), time spent serving hits and time
+    spent in the backend on misses.
+    Evictions and the size on disk are tracked for the cache as a whole.
+    '''
+    counters = ('hits', 'misses', 'stale', 'bytes', 'raw_bytes', 'hit_time',
+                'backend_time')
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.evictions = 0
+        self.size = 0
+        self.written = 0
+
+    def record(self, method, **counters):
+        with self.lock:
+            if method not in self.methods:
+                self.methods[method] = dict([(c, 0) for c in self.counters])
+            for counter in counters:
+                self.methods[method][counter] += counters[counter]
+        self.save()
+
+    def set_size(self, size, evictions=0):
+        with self.lock:
+            self.evictions += evictions
+            self.size = size
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'evictions': self.evictions,
+                'methods': dict([(m, dict(c)) for m, c in self.methods.items()]),
+            }
+
+    def save(self, force=False):
+        '''Writes the statistics to the stats file at most every stats_interval seconds'''
+        now = time.time()
+        if not force and now - self.written < stats_interval:
+            return
+        self.written = now
+        data = self.snapshot()
+        data['time'] = now
+        tmpname = os.path.join(self.path, '%s.%d' % (stats_file, os.getpid()))
+        try:
+            with open(tmpname, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmpname, os.path.join(self.path, stats_file))
+        except OSError:
+            pass
+
+
+def load_stats(path):
+    '''Reads the statistics file in cache directory path, None if there is none'''
+    try:
+        with open(os.path.join(path, stats_file)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def format_stats(namespace, data):
+    '''Formats a statistics snapshot as one line per cached method'''
+    lines = []
+    for method in sorted(data['methods']):
+        c = data['methods'][method]
+        lookups = c['hits'] + c['misses']
+        ratio = 0.0
+        if lookups:
+            ratio = 100.0 * c['hits'] / lookups
+        # what the hits would have cost if they had gone to the backend.
+        # Methods cheaper than reading their entries save nothing, which
+        # backend_time and hit_time show by how much.
+        saved = 0.0
+        if c['misses']:
+            saved = max(0.0, c['hits'] * c['backend_time'] / c['misses'] - c['hit_time'])
+        lines.append('%s %s hits=%d misses=%d stale=%d ratio=%.1f%% bytes=%d '
+                     'raw_bytes=%d backend_time=%.3fs hit_time=%.3fs '
+                     'saved=%.3fs' % (
+                     namespace or '-', method, c['hits'], c['misses'],
+                     c['stale'], ratio, c['bytes'], c.get('raw_bytes', 0),
+                     c['backend_time'], c['hit_time'], saved))
+    lines.append('%s total size=%d evictions=%d' % (namespace or '-',
+                 data['size'], data['evictions']))
+    return lines
 
 
 class CallableWrapper:
     name = None
     thecallable = None
-    cacheable_methods = ()
+    cache = None
 
-    def __init__(self, name, thecallable, cacheable_methods):
+    def __init__(self, name, thecallable, cache):
         self.name = name
         self.thecallable = thecallable
-        self.cacheable_methods = cacheable_methods
+        self.cache = cache
 
     def __call__(self, *args, **kwds):
-        if self.name not in self.cacheable_methods:
+        if self.name not in self.cache.policy.methods or self.name in self.cache.uncached:
             return self.thecallable(*args, **kwds)
         else:
-            filename = self._get_filename(*args, **kwds)
+            start = time.time()
+            generation = self._get_generation(*args)
+            filename = self._get_filename(generation, *args, **kwds)
             if os.path.exists(filename):
+                try:
+                    expire, result = self._get_cached_result(filename)
+                except entry_errors:
+                    return self._save_result(filename, *args, **kwds)
                 # check the expiration
-                expire, result = self._get_cached_result(filename)
                 diff = time.time() - expire
-                if diff > settings.nntp_cache_expire:
+                # entries keyed on a generation stay valid until the group
+                # changes, only the others expire
+                if generation is None and diff > self.cache.policy.expire:
                     # remove the file and run the method again
+                    self.cache.stats.record(self.name, stale=1)
                     return self._save_result(filename, *args, **kwds)
                 else:
+                    self.cache.touch(filename)
+                    self.cache.stats.record(self.name, hits=1,
+                                            hit_time=time.time() - start)
                     return result
             else:
-                return self._save_result(filename, *args, **kwds) 
+                return self._save_result(filename, *args, **kwds)
 
     def _get_cached_result(self, filename):
-        inf = open(filename, 'rb')
-        # get a lock on the file
-        portable_locker.lock(inf, portable_locker.LOCK_SH)
-        expire = pickle.load(inf)
-        result = pickle.load(inf)
-        # release the lock
-        portable_locker.unlock(inf)
-        inf.close()
-        return (expire, result)
+        # entries are replaced as a whole (see _save_result), so there is
+        # no need to lock them
+        with open(filename, 'rb') as inf:
+            expire = pickle.load(inf)
+            codec = pickle.load(inf)
+            payload = inf.read()
+        return (expire, decode_entry(codec, payload))
 
     def _save_result(self, filename, *args, **kwds):
+        start = time.time()
         result = self.thecallable(*args, **kwds)
-        # save the serialized result in the file
-        outf = open(filename, 'w')
-        # file write lock
-        portable_locker.lock(outf, portable_locker.LOCK_EX)
-        pickle.dump(time.time(), outf)
-        pickle.dump(result, outf)
-        # release the lock
-        portable_locker.unlock(outf)
-        outf.close()
+        backend_time = time.time() - start
+        policy = self.cache.policy
+        try:
+            codec, payload, raw_size = encode_entry(result, policy.compress,
+                                                    policy.compress_threshold)
+        except TypeError:
+            # streamed results (generators) can't be stored, nor should they
+            return result
+        # write the entry to a temporary file and move it into place, so a
+        # concurrent reader sees either the old entry or the new one, never
+        # a partly written one. The name starts with a dot, like the
+        # statistics file, so the entry listings skip it.
+        tmpname = os.path.join(os.path.dirname(filename), '.%s.tmp.%d.%d' % (
+            os.path.basename(filename), os.getpid(), threading.get_ident()))
+        try:
+            with open(tmpname, 'wb') as outf:
+                pickle.dump(time.time(), outf)
+                pickle.dump(codec, outf)
+                outf.write(payload)
+                size = outf.tell()
+            os.replace(tmpname, filename)
+        except OSError:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            return result
+        self.cache.account(filename, size)
+        self.cache.stats.record(self.name, misses=1, bytes=size,
+                                raw_bytes=size - len(payload) + raw_size,
+                                backend_time=backend_time)
         return result
 
-    def _get_filename(self, *args, **kwds):
-        arguments = '%s%s%s' % (self.name, args, kwds)
-        return '%s%s' % (settings.nntp_cache_path, binascii.hexlify(md5.new(arguments).digest()))
+    def _get_generation(self, *args):
+        '''
+        Returns the backend's generation for the group this call refers to,
+        or None if the backend does not provide generations.
+        '''
+        if self.cache.get_generation is None:
+            return None
+        group_name = None
+        if self.name in group_methods and len(args) > 0:
+            group_name = args[0]
+            for arg in args[1:]:
+                if str(arg).startswith('<'):
+                    group_name = None
+        return self.cache.get_generation(group_name)
+
+    def _get_filename(self, generation, *args, **kwds):
+        arguments = '%s%s%s%s' % (self.name, generation, args, kwds)
+        return os.path.join(self.cache.policy.path,
+                            md5(arguments.encode('utf-8')).hexdigest())
 
 
 class Cache:
+    '''
+    Wraps a storage backend and caches the results of the methods listed in
+    the policy on disk. storage_handle is either a storage module, in which
+    case its Papercut_Storage class is instantiated with the remaining
+    arguments, or an already constructed backend instance. Methods the
+    backend lists in its uncached_methods are never cached.
+    '''
     backend = None
-    cacheable_methods = ()
+    policy = None
 
-    def __init__(self, storage_handle, cacheable_methods):
-        self.backend = storage_handle.Papercut_Storage()
-        self.cacheable_methods = cacheable_methods
+    def __init__(self, storage_handle, policy, *args, **kwargs):
+        if hasattr(storage_handle, 'Papercut_Storage'):
+            self.backend = storage_handle.Papercut_Storage(*args, **kwargs)
+        else:
+            self.backend = storage_handle
+        self.policy = policy
+        self.get_generation = getattr(self.backend, 'get_generation', None)
+        # methods the backend needs to see every call of, whatever the policy
+        self.uncached = getattr(self.backend, 'uncached_methods', ())
+        self.lock = threading.Lock()
+        if not os.path.isdir(policy.path):
+            os.makedirs(policy.path)
+        # filename -> (mtime, size) of each entry. The directory is only
+        # listed here, from then on the index is kept up to date as entries
+        # are written, used and removed.
+        self.entries = dict((filename, (mtime, size)) for mtime, size, filename in self._entries())
+        self.size = sum([size for mtime, size in self.entries.values()])
+        # when entries unused for the expiry interval were last removed; the
+        # first write sweeps what earlier runs left behind
+        self.swept = 0
+        self.stats = CacheStats(policy.path)
+        self.stats.set_size(self.size)
 
     def __getattr__(self, name):
         result = getattr(self.backend, name)
         if callable(result):
-            result = CallableWrapper(name, result, self.cacheable_methods)
+            result = CallableWrapper(name, result, self)
         return result
 
+    def _entries(self):
+        '''Returns (mtime, size, filename) for all entries, oldest first'''
+        entries = []
+        for name in os.listdir(self.policy.path):
+            # skip the statistics file
+            if name.startswith('.'):
+                continue
+            filename = os.path.join(self.policy.path, name)
+            if not os.path.isfile(filename):
+                continue
+            st = os.stat(filename)
+            entries.append((st.st_mtime, st.st_size, filename))
+        entries.sort()
+        return entries
+
+    def touch(self, filename):
+        '''Marks an entry as used, for sweeping and eviction'''
+        now = time.time()
+        try:
+            os.utime(filename, (now, now))
+        except OSError:
+            return
+        with self.lock:
+            if filename in self.entries:
+                self.entries[filename] = (now, self.entries[filename][1])
+
+    def account(self, filename, size):
+        '''
+        Records a newly written (or overwritten) entry and, if the policy's
+        size budget is exceeded, evicts the least recently used entries
+        down to evict_low_water of it. Once per expiry interval, entries
+        that weren't used for that long are removed as well, whatever the
+        budget: entries keyed on a generation never expire, and once their
+        group changed nothing reads them again.
+        '''
+        with self.lock:
+            now = time.time()
+            old = self.entries.get(filename)
+            self.entries[filename] = (now, size)
+            self.size += size - (old[1] if old else 0)
+            evicted = 0
+            if now - self.swept > self.policy.expire:
+                self.swept = now
+                evicted += self._remove(filename,
+                                        lambda mtime: mtime < now - self.policy.expire)
+            if self.policy.size and self.size > self.policy.size:
+                low_water = self.policy.size * evict_low_water
+                evicted += self._remove(filename, lambda mtime: self.size > low_water)
+        self.stats.set_size(self.size, evicted)
+
+    def _remove(self, keep, wanted):
+        '''
+        Removes entries, least recently used first, as long as
+        wanted(mtime) holds, sparing keep. Returns the number removed.
+        '''
+        evicted = 0
+        entries = sorted(self.entries.items(), key=lambda item: item[1][0])
+        for entry, (mtime, entry_size) in entries:
+            if not wanted(mtime):
+                break
+            if entry == keep:
+                continue
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                # already gone, e.g. removed by hand
+                pass
+            except OSError:
+                continue
+            del self.entries[entry]
+            self.size -= entry_size
+            evicted += 1
+        return evicted
+
+    def get_stats(self):
+        '''Returns a snapshot of this cache's statistics'''
+        return self.stats.snapshot()
+
+
+def cached(backend, name):
+    '''Whether a Cache keeps the results of the named method'''
+    return name in backend.policy.methods and name not in backend.uncached
+
+
+def warm_group(backend, group_name, tail):
+    '''
+    Pre-populates the cache with GROUP, the last tail XOVER lines and
+    LISTGROUP for one group, leaving out what the cache doesn't keep.
+    Returns the time taken in seconds.
+    '''
+    start = time.time()
+    if cached(backend, 'get_GROUP'):
+        total, first, last = backend.get_GROUP(group_name)
+    else:
+        # an uncached GROUP may do more than report the range, e.g. have
+        # the group polled
+        total, first, last = backend.get_group_stats(group_name)[:3]
+    if int(total) > 0 and cached(backend, 'get_XOVER'):
+        # the server passes ranges on as strings, so the cache keys only
+        # match if we do the same
+        start_id = max(int(first), int(last) - tail + 1)
+        backend.get_XOVER(group_name, str(start_id), str(last))
+    if cached(backend, 'get_LISTGROUP'):
+        backend.get_LISTGROUP(group_name)
+    return time.time() - start
+
+
+def warm(backend, concurrency=4, tail=500, report=None):
+    '''
+    Enumerates a cached backend's groups through get_LIST and warms them in
+    parallel, using at most concurrency threads. report(group_name, seconds,
+    error) is called as each group finishes. Returns the number of groups
+    warmed successfully.
+    '''
+    groups = []
+    for line in backend.get_LIST().split('\r\n'):
+        if line.strip():
+            groups.append(line.split()[0])
+
+    def warm_one(group_name):
+        try:
+            seconds = warm_group(backend, group_name, tail)
+        except Exception as e:
+            if report:
+                report(group_name, 0, e)
+            return False
+        if report:
+            report(group_name, seconds, None)
+        return True
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return sum(executor.map(warm_one, groups))
@@ -73,6 +73,30 @@ CONFIG_DEFAULT = {
   # Path to the directory where the cache should be kept (you can use shell
   # environment variables)
   'nntp_cache_path': '/var/cache/papercut',
+  # Backend methods whose results get cached (list of method names, e.g.
+  # [get_XOVER, get_BODY]). None caches all methods in
+  # papercut_cache.cache_methods.
+  'nntp_cache_methods': None,
+  # Disk space the cache may use in bytes (0 means unlimited). Once exceeded
+  # the least recently used entries are removed until 90% of it is used.
+  # Entries not used for the expiration interval are removed either way.
+  'nntp_cache_size': 0,
+  # Subdirectory of nntp_cache_path to keep the global backend's cache
+  # entries in. Hierarchy specific backends use the hierarchy name unless
+  # their own block sets nntp_cache_namespace.
+  'nntp_cache_namespace': '',
+  # Compression for cache entries ('none', 'zlib' or 'lzma'). Only entries
+  # larger than nntp_cache_compress_threshold bytes get compressed.
+  'nntp_cache_compress': 'none',
+  'nntp_cache_compress_threshold': 4096,
+  # Whether to warm the caches at startup, before accepting connections
+  # ('yes' or 'no'; papercut_cache_warm does the same on demand, through
+  # the running server). Warming fetches GROUP, the last
+  # nntp_cache_warm_xover overview lines and LISTGROUP for every group,
+  # nntp_cache_warm_concurrency groups at a time.
+  'nntp_cache_warm': 'no',
+  'nntp_cache_warm_concurrency': 4,
+  'nntp_cache_warm_xover': 500,
 
   ## Storage module configuration ##
 
@@ -103,12 +127,72 @@ CONFIG_DEFAULT = {
   # [maildir] directory where maildirs are located (you can use shell
   # environment variables)
   'maildir_path': "$HOME/Maildir",
+  # [xenforo_api] API key and URL of the XenForo forum to expose
+  'xenforo_api_key': '',
+  'xenforo_api_url': 'https://forums.example.com/api',
+  # [xenforo_api] directory to keep the forum snapshot in (you can use shell
+  # environment variables)
+  'xenforo_api_spool': '/var/spool/papercut',
+  # [xenforo_api] seconds between background syncs with the forum (0 disables
+  # background syncing, new posts then only show up after a restart). Each
+  # forum is polled about as often as it gets new posts, but no more often
+  # than this and no less often than xenforo_api_sync_max_interval seconds.
+  'xenforo_api_sync_interval': 60,
+  'xenforo_api_sync_max_interval': 6 * 3600,
+  # [xenforo_api] API requests per hour background syncs may use (0 for no
+  # limit); forums that changed wait for their turn when it is used up
+  'xenforo_api_request_budget': 0,
+  # [xenforo_api] threads per polled forum whose newest page of posts is
+  # fetched again on every poll, taking turns through all of a forum's
+  # threads, to find edited posts (0 disables this). Edits don't move the
+  # forum listing, so otherwise only the webhook listener (below) sees them.
+  'xenforo_api_edit_recheck_threads': 5,
+  # [xenforo_api] number of API requests to run concurrently (also the size
+  # of the HTTP connection pool)
+  'xenforo_api_concurrency': 8,
+  # [xenforo_api] how often to retry rate limited (HTTP 429) requests, and
+  # the timeout for a single request in seconds
+  'xenforo_api_max_retries': 5,
+  'xenforo_api_timeout': 30,
+  # [xenforo_api] number of rendered post bodies to keep in memory (0
+  # disables the cache), and whether to also keep them in the spool
+  # directory across restarts ('yes' or 'no')
+  'xenforo_api_body_cache_size': 2000,
+  'xenforo_api_body_cache_disk': 'no',
+  # [xenforo_api] only keep what overviews need of each post in memory and
+  # in the snapshot, and fetch post bodies from the forum the first time they
+  # are read ('yes' or 'no'). Fetched bodies are kept in the spool directory
+  # and the most recently used ones (see above) in memory.
+  'xenforo_api_lazy_bodies': 'no',
+  # [xenforo_api] how the binaries.test group encodes attachments ('yenc' or
+  # 'base64', the latter as a MIME message), and how many bytes of
+  # attachment data to keep in the spool directory for serving them
+  'xenforo_api_attachment_encoding': 'yenc',
+  'xenforo_api_attachment_cache_size': 256 * 1024 * 1024,
+  # [xenforo_api] syncs are journaled next to the forum snapshot; once the
+  # journal grows past this many bytes it is folded into the snapshot
+  'xenforo_api_journal_max': 16 * 1024 * 1024,
+  # [xenforo_api] port to listen on for XenForo webhooks (0 disables the
+  # listener), the address to bind to and the secret configured for the
+  # webhook in XenForo. With webhooks, the forum is only polled every
+  # xenforo_api_webhook_reconcile_interval seconds to catch missed ones.
+  # Without them, edits are only found by xenforo_api_edit_recheck_threads,
+  # a few threads per poll, so they can take many polls to show up.
+  'xenforo_api_webhook_port': 0,
+  'xenforo_api_webhook_address': '127.0.0.1',
+  'xenforo_api_webhook_secret': '',
+  'xenforo_api_webhook_reconcile_interval': 3600,
 
   # Hierarchy specific configuration (dict). This can be used to create
   # hierarchies such as my.hierarchy where your groups, e.g.
   # my.hierarchy.agroup, my.hierarchy.bgroup appear. For backend plugins that
   # support this (currently just maildir) multiple instances of the same
   # backend (each with its dedicated configuration) will be created.
+  # Each hierarchy may also set its own cache policy through the nntp_cache,
+  # nntp_cache_expire, nntp_cache_methods, nntp_cache_size,
+  # nntp_cache_namespace, nntp_cache_compress and
+  # nntp_cache_compress_threshold keys, which default to the global settings
+  # above.
 
   'hierarchies': None,
 }
@@ -120,6 +204,7 @@ PATH_KEYS = {
   'nntp_cache_path': 1,
   'mbox_path': 1,
   'maildir_path': 1,
+  'xenforo_api_spool': 1,
 }
 
 # Will hold the sole authoritative instance of the Config class below.
@@ -134,8 +219,8 @@ def CONF():
 
 def OPTS():
   '''Helper function for convenient access to command line options'''
-  if configuration is None:
-    configuration = Config()
+  if CONFIG is None:
+    CONF = Config()
   return CONF.opts
   
 
@@ -197,6 +282,31 @@ class Config:
       opts.add_argument('-c', '--config', default=None, action='append',
                help="Load configuration from this file (may be specified multiple times)")
 
+    if os.path.basename(sys.argv[0]) == 'papercut_cache_stats':
+      opts = argparse.ArgumentParser(
+               description='%s - Show papercut cache statistics' % sys.argv[0])
+      opts.add_argument('-c', '--config', default=None, action='append',
+               help="Load configuration from this file (may be specified multiple times)")
+
+    if os.path.basename(sys.argv[0]) == 'papercut_cache_warm':
+      opts = argparse.ArgumentParser(
+               description='%s - Warm the caches of a running papercut server' % sys.argv[0])
+      opts.add_argument('-c', '--config', default=None, action='append',
+               help="Load configuration from this file (may be specified multiple times)")
+      opts.add_argument('-u', '--user', default=None,
+               help="Authenticate as this user (if nntp_auth is 'yes')")
+      opts.add_argument('-p', '--password', default=None,
+               help="Password for --user")
+
+    # Anything else (e.g. the benchmark scripts in bench/) only gets --config
+    # and may bring its own options.
+    if opts is None:
+      opts = argparse.ArgumentParser(
+               description='%s - Papercut' % sys.argv[0])
+      opts.add_argument('-c', '--config', default=None, action='append',
+               help="Load configuration from this file (may be specified multiple times)")
+      return opts.parse_known_args()[0]
+
     return opts.parse_args()
 
 
@@ -256,6 +366,15 @@ class Config:
     if self.config.phorum_settings_path[-1] != '/':
         self.config.phorum_settings_path = cfg.phorum_settings_path + '/'
 
+    if self.config.nntp_cache_compress not in ('none', 'zlib', 'lzma'):
+        sys.exit("Please set 'nntp_cache_compress' to one of none, zlib or lzma")
+
+    if self.config.xenforo_api_attachment_encoding not in ('yenc', 'base64'):
+        sys.exit("Please set 'xenforo_api_attachment_encoding' to one of yenc or base64")
+
+    if self.config.xenforo_api_webhook_port and self.config.xenforo_api_webhook_secret == '':
+        sys.exit("Please set 'xenforo_api_webhook_secret' to the secret of the XenForo webhook")
+
   def merge_configs(self, configs):
     '''Merges a list of configuration dicts into one final configuration dict'''
     cfg = m9dicts.make()
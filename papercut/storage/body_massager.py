@@ -2,14 +2,32 @@ import bbcode
 import re
 import pprint
 import textwrap
+import threading
 
 pp = pprint.PrettyPrinter(indent=2)
 
 class Body_Massager:
+    # the parser holds no state between format() calls, so one is built on
+    # first use and shared by all instances and threads
+    _parser = None
+    _parser_lock = threading.Lock()
+
     def __init__(self):
         pass
 
+    @classmethod
+    def parser(cls):
+        if cls._parser is None:
+            with cls._parser_lock:
+                if cls._parser is None:
+                    cls._parser = cls._build_parser()
+        return cls._parser
+
     def massage(self, post):
+        return self.parser().format(post['message'])
+
+    @staticmethod
+    def _build_parser():
         parser = bbcode.Parser(
             install_defaults=False,
             newline="\n",
@@ -50,22 +68,22 @@ class Body_Massager:
         parser.add_formatter('media', _render_media, escape_html=False)
         
         # stuff stolen from bbcode.py because not easily reusable
-        
-        def _render_url(name, value, options, parent, context):
-            # Adapted from http://daringfireball.net/2010/07/improved_regex_for_matching_urls
-            # Changed to only support one level of parentheses, since it was failing catastrophically on some URLs.
-            # See http://www.regular-expressions.info/catastrophic.html
-            _url_re = re.compile(
-                r"(?im)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)"
-                r'(?:[^\s()<>]+|\([^\s()<>]+\))+(?:\([^\s()<>]+\)|[^\s`!()\[\]{};:\'".,<>?]))'
-            )
-
-            # For the URL tag, try to be smart about when to append a missing http://. If the given link looks like a domain,
-            # add a http:// in front of it, otherwise leave it alone (since it may be a relative path, a filename, etc).
-            _domain_re = re.compile(
-                r"(?im)(?:www\d{0,3}[.]|[a-z0-9.\-]+[.](?:com|net|org|edu|biz|gov|mil|info|io|name|me|tv|us|uk|mobi))"
-            )
 
+        # Adapted from http://daringfireball.net/2010/07/improved_regex_for_matching_urls
+        # Changed to only support one level of parentheses, since it was failing catastrophically on some URLs.
+        # See http://www.regular-expressions.info/catastrophic.html
+        _url_re = re.compile(
+            r"(?im)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)"
+            r'(?:[^\s()<>]+|\([^\s()<>]+\))+(?:\([^\s()<>]+\)|[^\s`!()\[\]{};:\'".,<>?]))'
+        )
+
+        # For the URL tag, try to be smart about when to append a missing http://. If the given link looks like a domain,
+        # add a http:// in front of it, otherwise leave it alone (since it may be a relative path, a filename, etc).
+        _domain_re = re.compile(
+            r"(?im)(?:www\d{0,3}[.]|[a-z0-9.\-]+[.](?:com|net|org|edu|biz|gov|mil|info|io|name|me|tv|us|uk|mobi))"
+        )
+
+        def _render_url(name, value, options, parent, context):
             if options and "url" in options:
                 href = options["url"]
                 # Completely ignore javascript: and data: "links".
@@ -177,5 +195,5 @@ class Body_Massager:
 
         parser.add_formatter("table", _render_table, escape_html=False)
         
-        return parser.format(post['message'])
+        return parser
     
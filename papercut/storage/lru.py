@@ -0,0 +1,149 @@
+import collections
+import os
+import threading
+
+
+class LRUCache:
+    '''
+    Thread safe, size bounded mapping of keys to strings that drops the
+    least recently used entry when full. With a path, entries are also
+    written to one file each below it and read back on a miss, so they
+    survive restarts; keys then have to be tuples of strings and numbers.
+    '''
+
+    def __init__(self, maxsize, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(self.path, '-'.join(str(part) for part in key))
+
+    def get(self, key):
+        '''Returns the value stored for key, or None'''
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                return value
+        if self.path is None:
+            return None
+        try:
+            with open(self._filename(key), encoding='utf-8', newline='') as f:
+                value = f.read()
+        except OSError:
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.path is not None:
+            filename = self._filename(key)
+            # one temporary file per thread, several may store the same key
+            temp = '%s.%d.tmp' % (filename, threading.get_ident())
+            with open(temp, 'w', encoding='utf-8', newline='') as f:
+                f.write(value)
+            os.replace(temp, filename)
+
+    def discard(self, key):
+        '''Forgets the entry stored for key, if any'''
+        with self.lock:
+            self.entries.pop(key, None)
+        if self.path is not None:
+            try:
+                os.remove(self._filename(key))
+            except OSError:
+                pass
+
+    def _remember(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+class FileCache:
+    '''
+    Size bounded directory of files, one per key, for data too large to
+    keep in memory. Opening a file marks it as used; when storing one takes
+    the directory past maxsize bytes, the least recently used files go.
+    The directory is the only state, so several processes can share it.
+    '''
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(self.path, str(key))
+
+    def open(self, key):
+        '''Returns the file stored for key opened for reading, or None'''
+        filename = self._filename(key)
+        try:
+            f = open(filename, 'rb')
+        except OSError:
+            return None
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return f
+
+    def store(self, key, chunks):
+        '''
+        Writes the data in chunks, an iterable of bytes, to the file of key
+        and returns it opened for reading
+        '''
+        filename = self._filename(key)
+        # one temporary file per thread, several may store the same key
+        temp = '%s.%d.tmp' % (filename, threading.get_ident())
+        try:
+            with open(temp, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(temp, filename)
+        except BaseException:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+        # open it before evicting, the file outlives its removal
+        f = open(filename, 'rb')
+        self._evict(filename)
+        return f
+
+    def _evict(self, keep):
+        with self.lock:
+            files = []
+            size = 0
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+                size += stat.st_size
+            files.sort()
+            for mtime, filename, file_size in files:
+                if size <= self.maxsize:
+                    break
+                if filename == keep:
+                    continue
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                size -= file_size
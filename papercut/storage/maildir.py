@@ -302,6 +302,27 @@ class Papercut_Storage:
         new_to_cur(self._get_group_dir(group))
         self.cache.refresh_dircache(group)
 
+    def _group_generation(self, group):
+        groupdir = self._get_group_dir(group)
+        try:
+            return max([os.stat(os.path.join(groupdir, d)).st_mtime_ns
+                        for d in ('cur', 'new')])
+        except OSError:
+            return None
+
+    def get_generation(self, group_name=None):
+        '''
+        Returns the newest modification time of the group's cur and new
+        directories (or of all groups' if group_name is None). It changes
+        whenever a message is added, moved or removed.
+        '''
+        if group_name is not None:
+            return self._group_generation(self._groupname2group(group_name))
+        generations = [os.stat(self.maildir_path).st_mtime_ns]
+        for group in os.listdir(self.maildir_path):
+            generations.append(self._group_generation(group) or 0)
+        return max(generations)
+
     def get_groupname_list(self):
         groups = dircache.listdir(self.maildir_path)
         group_list = []
@@ -25,6 +25,16 @@ class Papercut_Storage:
     def get_file_list(self):
         return os.listdir(self.mbox_dir)
 
+    def get_generation(self, group_name=None):
+        if group_name is None:
+            files = self.get_file_list()
+        else:
+            files = [group_name.replace('papercut.mbox.', '')]
+        try:
+            return max([os.stat(os.path.join(self.mbox_dir, f)).st_mtime_ns for f in files] + [0])
+        except OSError:
+            return None
+
     def get_group_list(self):
         groups = self.get_file_list()
         return ["papercut.mbox.%s" % k for k in groups]
@@ -25,6 +25,8 @@ class Papercut_Storage:
     def __init__(self):
         self.conn = MySQLdb.connect(host=settings.dbhost, db=settings.dbname, user=settings.dbuser, passwd=settings.dbpass)
         self.cursor = self.conn.cursor()
+        # table names by group, for get_generation()
+        self.table_names = {}
 
     def quote_string(self, text):
         """Quotes strings the MySQL way."""
@@ -90,6 +92,22 @@ class Papercut_Storage:
         num_rows = self.cursor.execute(stmt)
         return self.cursor.fetchone()
 
+    def get_generation(self, group_name=None):
+        # MAX(id) grows with every new article, COUNT(id) catches deletions
+        if group_name is None:
+            return None
+        # it runs before every cached call, so it costs a single query
+        if group_name not in self.table_names:
+            self.table_names[group_name] = self.get_table_name(group_name)
+        stmt = """
+                SELECT
+                   IF(MAX(id) IS NULL, 0, MAX(id)) AS maximum,
+                   COUNT(id) AS total
+                FROM
+                    %s""" % (self.table_names[group_name])
+        self.cursor.execute(stmt)
+        return '%s.%s' % self.cursor.fetchone()
+
     def get_table_name(self, group_name):
         stmt = """
                 SELECT
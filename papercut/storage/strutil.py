@@ -1,4 +1,5 @@
 # Copyright (c) 2002 Joao Prado Maia. See the LICENSE file for more information.
+import fnmatch
 import time
 import re
 
@@ -66,3 +67,18 @@ def filterchars(text, characters):
             res += char
 
     return res
+
+def wildmat(name, pattern):
+    """Matches name against an RFC 3977 wildmat.
+
+    A wildmat is a comma separated list of patterns, the last one that
+    matches decides, and matching one that starts with '!' means no match.
+    """
+    matched = False
+    for part in pattern.split(','):
+        negated = part.startswith('!')
+        if negated:
+            part = part[1:]
+        if fnmatch.fnmatchcase(name, part):
+            matched = not negated
+    return matched
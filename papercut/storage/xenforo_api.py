@@ -1,12 +1,13 @@
 import bbcode
 import datetime
+import heapq
+import itertools
 import json
 import pickle
 import pprint
 import requests
 import re
 import textwrap
-import time
 
 import papercut.settings
 import papercut.storage.strutil as strutil
@@ -22,8 +23,24 @@ def slugify(str):
     
 def decut(group_name):
     return re.sub('^sgug\.', '', group_name)
+
+def number_lines(numbers, chunk=1000):
+    '''Yields article numbers as lines, chunk of them at a time'''
+    numbers = iter(numbers)
+    while True:
+        lines = "\r\n".join(map(str, itertools.islice(numbers, chunk)))
+        if not lines:
+            return
+        yield lines + "\r\n"
     
 class Papercut_Storage:
+    # GROUP asks for the group to be polled, which a cached answer would
+    # skip, and the stats it returns are kept with each snapshot anyway.
+    # LISTGROUP is streamed from the snapshot, so there is nothing to store.
+    uncached_methods = ('get_GROUP', 'get_LISTGROUP')
+    # get_LISTGROUP takes a range of article numbers
+    listgroup_range = True
+
     def __init__(self, *args, **kwargs):
         self.api_key = settings.xenforo_api_key
         self.api_url = settings.xenforo_api_url
@@ -31,108 +48,114 @@ class Papercut_Storage:
         self.xn = XenforoCommon(self.api_key, self.api_url, self.spool)
 
     def group_exists(self, group_name):
-        if decut(group_name) in self.xn.forums:
+        if decut(group_name) in self.xn.snapshots:
             return True
         else:
             return False
 
+    def get_generation(self, group_name=None):
+        if group_name is None:
+            return self.xn.generation()
+        group = decut(group_name)
+        if group not in self.xn.snapshots:
+            return None
+        return self.xn.generation(group)
+
     def get_message_id(self, msg_num, group_name):
         group = decut(group_name)
-        return self.xn.forums[group]['posts'][int(msg_num) - 1]['nntp_message_id']
+        post = self.xn.snapshot(group).get_article(msg_num)
+        if post is None:
+            return None
+        return post.nntp_message_id
         
     def get_LIST(self, username=""):
         lists = []
-        for group in self.xn.forums:
-            msgcount = len(self.xn.forums[group]['posts'])
+        for group, snapshot in self.xn.snapshots.items():
+            msgcount, low, high = snapshot.article_stats()
             lists.append("sgug.%s %s %s y" % (
                 group,
-                msgcount,
-                msgcount
+                high,
+                low
             ))
         return "\r\n".join(lists)
 
     def get_group_stats(self, group_name):
         group = decut(group_name)
-        msgcount = len(self.xn.forums[group]['posts'])
-        return (msgcount, 1, msgcount, group_name)
+        msgcount, low, high = self.xn.snapshot(group).article_stats()
+        return (msgcount, low, high, group_name)
     
     def get_GROUP(self, group_name):
-        group = decut(group_name)
-        msgcount = len(self.xn.forums[group]['posts']) 
-        min_mark = 1
-        return (
-            msgcount,
-            min_mark,
-            msgcount
-        )
+        # a client is about to read the group, have it polled right away
+        self.xn.request_refresh(decut(group_name))
+        # article numbers are stable, so there can be gaps between low and high
+        return self.xn.snapshot(decut(group_name)).article_stats()
 
     def get_NEWGROUPS(self, ts, group='%'):
-        # TODO: could be done
-        return None
+        groups = []
+        for group, snapshot in self.xn.snapshots.items():
+            if snapshot.first_seen >= ts:
+                msgcount, low, high = snapshot.article_stats()
+                groups.append("sgug.%s %s %s y" % (group, high, low))
+        if len(groups) == 0:
+            return None
+        return "\r\n".join(groups)
 
-    def get_LISTGROUP(self, group_name):
+    def get_NEWNEWS(self, ts, group='*'):
+        # each forum yields its new posts in date order, merging them as they
+        # come keeps the list for all forums in date order too
+        since = [snapshot.msgids_since(ts) for slug, snapshot in self.xn.snapshots.items()
+                 if strutil.wildmat('sgug.%s' % slug, group)]
+        posts = heapq.merge(*since, key=lambda item: item[0])
+        return "\r\n".join(msgid for post_date, msgid in posts)
+
+    def get_LISTGROUP(self, group_name, start=None, end=None):
         group = decut(group_name)
-        ret = []
-        for val in range(1, len(self.xn.forums[group]['posts']) + 1):
-            ret.append(str(val))
-        return "\r\n".join(ret)
+        # article numbers are stable, so the lines are made from the
+        # snapshot's number map as they are sent
+        return number_lines(self.xn.snapshot(group).article_numbers(start, end))
     
-    def get_XOVER(self, group_name, start_id, end_id=100):
+    def get_XOVER(self, group_name, start_id, end_id=None):
         group = decut(group_name)
 
-        if len(self.xn.forums[group]['posts']) == 0:
-            return ""
-        
-        overviews = []
-        
-        # message_number <tab> subject <tab> author <tab> date <tab> message_id <tab> reference <tab> bytes <tab> lines <tab> xref
-        for index, post in enumerate(self.xn.forums[group]['posts'][int(start_id) - 1:int(end_id)]):
-            if 'reference' in post:
-                reference = post['reference']
-            else:
-                reference = ''
-            msg_num = index + 1
-            overviews.append("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
-                msg_num,
-                post['nntp_subject'],
-                post['username'],
-                strutil.get_formatted_time(time.localtime(post['post_date'])),
-                post['nntp_message_id'],
-                reference,
-                8192,
-                50,
-                'Xref: %s %s:%s' % (settings.nntp_hostname, group_name, msg_num)
-            ))
-
-        return "\r\n".join(overviews)
+        # the lines are built once per post when it gets indexed, and read
+        # from the snapshot file's overview column as they are
+        return "\r\n".join(self.xn.snapshot(group).overview_range(start_id, end_id))
         
     def get_HEAD(self, group_name, id):
         if id[0] == "0":
             return None
         elif id[0] == '<':
-            return self.xn.create_usenet_headers(self.xn.posts_by_msgid[id], id)
+            post = self.xn.find_post(id)
         else:
-            group = decut(group_name)
-            return self.xn.create_usenet_headers(self.xn.forums[group]['posts'][int(id) - 1], id)
+            post = self.xn.snapshot(decut(group_name)).get_article(id)
+        if post is None:
+            return None
+        return self.xn.create_usenet_headers(post, id)
 
     def get_BODY(self, group_name, id):
         if id[0] == "0":
             return None
         elif id[0] == '<':
-            return self.xn.format_message(self.xn.posts_by_msgid[id])
+            post = self.xn.find_post(id)
         else:
-            group = decut(group_name)
-            return self.xn.format_message(self.xn.forums[group]['posts'][int(id) - 1])
+            post = self.xn.snapshot(decut(group_name)).get_article(id)
+        if post is None:
+            return None
+        return self.xn.format_message(post)
 
     def get_ARTICLE(self, group_name, id):
+        head = self.get_HEAD(group_name, id)
+        if head is None:
+            # lets lookups by message ID go on to the other backends
+            return None
         return (
-            self.get_HEAD(group_name, id),
+            head,
             self.get_BODY(group_name, id)
         )
 
     def get_XGTITLE(self, pattern=None):
         ret = []
-        for group in self.xn.forums:
-            ret.append('sgug.%s %s' % (group, self.xn.forums[group]['description']))
+        for group, snapshot in self.xn.snapshots.items():
+            ret.append('sgug.%s %s' % (group, snapshot.description))
         return "\r\n".join(ret)
 
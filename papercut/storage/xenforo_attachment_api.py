@@ -1,35 +1,116 @@
+import base64
 import bbcode
 import datetime
 import json
+import mimetypes
+import os
 import pickle
 import pprint
 import requests
 import re
 import textwrap
 import time
+import zlib
 
 import papercut.settings
 import papercut.storage.strutil as strutil
 
+from .lru import FileCache
 from .xenforo_common import XenforoCommon
 
 settings = papercut.settings.CONF()
 pp = pprint.PrettyPrinter(indent=2)
 
+MESSAGE_ID = '<attachment.%s@forums.sgi.sh>'
+MESSAGE_ID_RE = re.compile(r'<attachment\.([0-9]+)@forums\.sgi\.sh>$')
+
+# attachments are read and encoded this many bytes at a time; a multiple of
+# 57, the bytes in one line of base64
+CHUNK_SIZE = 57 * 1024
+# characters per line of yEnc, not counting the escape characters
+YENC_LINE = 128
+
+# yEnc adds 42 to every byte and escapes NUL, LF, CR and '=' (with '=' and
+# the byte plus 64), as well as tabs and spaces at either end of a line and
+# dots at its start
+YENC_TABLE = bytes((byte + 42) & 0xff for byte in range(256))
+YENC_CRITICAL = re.compile(b'[\\x00\\n\\r=]')
+
 def slugify(str):
     return re.sub('[^a-z0-9]+', '-', str.lower())
     
 def decut(group_name):
     return re.sub('^sgug\.', '', group_name)
+
+def yenc_escape(byte):
+    return b'=' + bytes(((byte + 64) & 0xff,))
+
+def yenc_line(line):
+    if line[:1] in (b'\t', b' ', b'.'):
+        line = yenc_escape(line[0]) + line[1:]
+    if line[-1:] in (b'\t', b' '):
+        line = line[:-1] + yenc_escape(line[-1])
+    # latin-1 maps bytes to characters one to one, and back when sent
+    return line.decode('latin-1') + '\r\n'
+
+def yenc_encode(f, name, size):
+    '''
+    Yields the content of file f yEnc encoded, a chunk of lines at a time,
+    and closes it when done
+    '''
+    with f:
+        yield '=ybegin line=%d size=%d name=%s\r\n' % (YENC_LINE, size, name)
+        crc = 0
+        rest = b''
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            encoded = rest + YENC_CRITICAL.sub(lambda m: yenc_escape(m.group()[0]),
+                                               data.translate(YENC_TABLE))
+            lines = []
+            start = 0
+            while len(encoded) - start > YENC_LINE:
+                end = start + YENC_LINE
+                # '=' only ever starts an escape, which stays on one line
+                if encoded[end - 1] == 0x3d:
+                    end += 1
+                lines.append(yenc_line(encoded[start:end]))
+                start = end
+            rest = encoded[start:]
+            yield ''.join(lines)
+        if rest:
+            yield yenc_line(rest)
+        yield '=yend size=%d crc32=%08x\r\n' % (size, crc)
+
+def base64_encode(f):
+    '''
+    Yields the content of file f base64 encoded, a chunk of lines at a
+    time, and closes it when done
+    '''
+    with f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield base64.encodebytes(data).decode('ascii').replace('\n', '\r\n')
+    
     
 class Papercut_Storage:
     group_name = 'binaries.test'
+    # get_LISTGROUP takes a range of article numbers
+    listgroup_range = True
     
     def __init__(self, *args, **kwargs):
         self.api_key = settings.xenforo_api_key
         self.api_url = settings.xenforo_api_url
         self.spool = settings.xenforo_api_spool
         self.xn = XenforoCommon(self.api_key, self.api_url, self.spool)
+        self.encoding = settings.xenforo_api_attachment_encoding
+        # attachment data by attachment ID, fetched the first time it is read
+        self.files = FileCache('%s/%s' % (self.spool, 'attachments'),
+                               settings.xenforo_api_attachment_cache_size)
         
     def group_exists(self, group_name):
         if group_name == self.group_name:
@@ -37,34 +118,164 @@ class Papercut_Storage:
         else:
             return False
 
+    def get_generation(self, group_name=None):
+        return len(self.xn.attachments)
+
+    def get_message_id(self, msg_num, group_name):
+        found = self.find_attachment(str(msg_num))
+        if found is None:
+            return None
+        return MESSAGE_ID % found[1]['attachment_id']
+
     def get_LIST(self, username=""):
         attcnt = len(self.xn.attachments)
         return "\r\n%s %s %s y\r\n" % (self.group_name, attcnt, attcnt)
 
+    def get_group_stats(self, group_name):
+        attcnt = len(self.xn.attachments)
+        return (attcnt, 1, attcnt, group_name)
+
     def get_GROUP(self, group_name):
         attcnt = len(self.xn.attachments)
         return (attcnt, 1, attcnt)
 
+    def get_NEWGROUPS(self, ts, group='%'):
+        return None
+
+    def get_LISTGROUP(self, group_name, start=None, end=None):
+        attcnt = len(self.xn.attachments)
+        start = 1 if start is None else max(int(start), 1)
+        end = attcnt if end is None else min(int(end), attcnt)
+        return "\r\n".join(str(number) for number in range(start, end + 1))
+
+    def get_NEWNEWS(self, ts, group='*'):
+        if not strutil.wildmat(self.group_name, group):
+            return ''
+        attachments = [attachment for attachment in self.xn.attachments if attachment['attach_date'] >= ts]
+        attachments.sort(key=lambda attachment: attachment['attach_date'])
+        return "\r\n".join(MESSAGE_ID % attachment['attachment_id'] for attachment in attachments)
+
     def get_XOVER(self, group_name, start_id, end_id=100):
         if group_name != self.group_name:
             return None
 
         overviews = []
         
-        for index, attachment in enumerate(self.xn.attachments[int(start_id) - 1:int(end_id)]):
-            print(attachment)
-            msg_num = index + 1
+        start = max(int(start_id), 1)
+        for msg_num, attachment in enumerate(self.xn.attachments[start - 1:int(end_id)], start):
+            size, lines = self.body_size(attachment)
             overviews.append("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
                 msg_num,
-                attachment['filename'],
+                self.subject(attachment),
                 'N/A',
                 strutil.get_formatted_time(time.localtime(attachment['attach_date'])),
-                '<attachment.%s@forums.sgi.sh>' % attachment['attachment_id'],
+                MESSAGE_ID % attachment['attachment_id'],
                 '',
-                8192,
-                50,
+                size,
+                lines,
                 'Xref: %s %s:%s' % (settings.nntp_hostname, group_name, msg_num)
             ))
 
         return "\r\n".join(overviews)
-            
+
+    def get_HEAD(self, group_name, id):
+        found = self.find_attachment(id)
+        if found is None:
+            return None
+        return self.create_headers(*found)
+
+    def get_BODY(self, group_name, id):
+        '''
+        Returns an iterable of the encoded attachment's lines, which the
+        server sends as they are encoded
+        '''
+        found = self.find_attachment(id)
+        if found is None:
+            return None
+        f = self.open_data(found[1])
+        if f is None:
+            return None
+        if self.encoding == 'base64':
+            return base64_encode(f)
+        return yenc_encode(f, found[1]['filename'], os.fstat(f.fileno()).st_size)
+
+    def get_ARTICLE(self, group_name, id):
+        head = self.get_HEAD(group_name, id)
+        if head is None:
+            return None
+        body = self.get_BODY(group_name, id)
+        if body is None:
+            return None
+        return (head, body)
+
+    def find_attachment(self, id):
+        '''
+        Returns the (article number, attachment) an article number or
+        message ID refers to, or None
+        '''
+        if id[0] == '<':
+            match = MESSAGE_ID_RE.match(id)
+            if match is None:
+                return None
+            number = self.xn.attachment_numbers.get(int(match.group(1)))
+        elif id.isdigit():
+            number = int(id)
+        else:
+            return None
+        if number is None or not 1 <= number <= len(self.xn.attachments):
+            return None
+        return (number, self.xn.attachments[number - 1])
+
+    def open_data(self, attachment):
+        '''
+        Returns an attachment's data opened for reading, fetching it into
+        the cache first if it isn't there, or None if it can't be had
+        '''
+        attachment_id = attachment['attachment_id']
+        f = self.files.open(attachment_id)
+        if f is not None:
+            return f
+        try:
+            return self.files.store(attachment_id,
+                                    self.xn.api_get_data('/attachments/%s/data' % attachment_id))
+        except requests.exceptions.RequestException as e:
+            print("attachment %s: %s" % (attachment_id, e))
+            return None
+
+    def subject(self, attachment):
+        if self.encoding == 'base64':
+            return attachment['filename']
+        # the form newsreaders look for to put binaries together
+        return '"%s" yEnc (1/1)' % attachment['filename']
+
+    def body_size(self, attachment):
+        '''
+        Returns the (bytes, lines) of an attachment's body, going by its
+        file size. Exact for base64; yEnc escapes about one byte in 64.
+        '''
+        size = attachment['file_size']
+        if self.encoding == 'base64':
+            lines = (size + 56) // 57
+            return (4 * ((size + 2) // 3) + 2 * lines, lines)
+        encoded = size + size // 64
+        lines = (encoded + YENC_LINE - 1) // YENC_LINE + 2
+        return (encoded + 2 * lines + 100, lines)
+
+    def create_headers(self, number, attachment):
+        size, lines = self.body_size(attachment)
+        headers = []
+        headers.append("Path: %s" % (settings.nntp_hostname))
+        headers.append("From: N/A")
+        headers.append("Newsgroups: %s" % (self.group_name))
+        headers.append("Date: %s" % (strutil.get_formatted_time(time.localtime(attachment['attach_date']))))
+        headers.append("Subject: %s" % (self.subject(attachment)))
+        headers.append("Message-ID: %s" % (MESSAGE_ID % attachment['attachment_id']))
+        headers.append("Lines: %s" % (lines))
+        headers.append("Xref: %s %s:%s" % (settings.nntp_hostname, self.group_name, number))
+        if self.encoding == 'base64':
+            content_type = mimetypes.guess_type(attachment['filename'])[0] or 'application/octet-stream'
+            headers.append("MIME-Version: 1.0")
+            headers.append('Content-Type: %s; name="%s"' % (content_type, attachment['filename']))
+            headers.append("Content-Transfer-Encoding: base64")
+            headers.append('Content-Disposition: attachment; filename="%s"' % (attachment['filename']))
+        return "\r\n".join(headers)
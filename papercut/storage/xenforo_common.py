@@ -1,28 +1,324 @@
 import bbcode
+import bisect
 import datetime
+import heapq
+import itertools
 import json
-import pickle
 import pprint
 import requests
 import re
+import sys
 import textwrap
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import papercut.settings
 import papercut.storage.strutil as strutil
 
 from .body_massager import Body_Massager
+from .lru import LRUCache
+from .xenforo_store import SnapshotStore
+from . import xenforo_webhook
 
 settings = papercut.settings.CONF()
 pp = pprint.PrettyPrinter(indent=2)
 
 # when changing anything in self.forums or the reader routines,
-# increment this to make the thing ditch the old pickle
-MEGASTRUCTURE_VERSION=14
+# increment this to make the thing ditch the old snapshot
+MEGASTRUCTURE_VERSION=19
+
+# number of (time seen, last post date, post count) samples kept per forum
+# to learn how busy it is
+ACTIVITY_SAMPLES = 8
+# GROUP asks for a forum to be polled right away, at most this often
+REFRESH_MIN_AGE = 60
 
 def slugify(str):
     return re.sub('[^a-z0-9]+', '-', str.lower())
 
+def overview_field(str):
+    '''Tabs and line breaks would break the overview line'''
+    return re.sub('[\t\r\n]+', ' ', str)
+
+class Post:
+    '''
+    What papercut keeps of a forum post, instead of the whole API dict.
+    Strings repeated across posts are interned, so e.g. all replies in a
+    thread share one subject. message is None with xenforo_api_lazy_bodies
+    once the overview is built.
+    '''
+    __slots__ = ('post_id', 'thread_id', 'post_date', 'last_edit_date',
+                 'username', 'message', 'nntp_message_id', 'nntp_subject',
+                 'nntp_group_name', 'references', 'article_number', 'overview')
+
+    def __init__(self, data, nntp_subject, nntp_group_name, nntp_references):
+        self.post_id = data['post_id']
+        self.thread_id = data['thread_id']
+        self.post_date = data['post_date']
+        self.last_edit_date = data.get('last_edit_date', 0)
+        self.username = sys.intern(data['username'])
+        self.message = data['message']
+        self.nntp_message_id = '<%d.%d@forums.sgi.sh>' % (self.post_date, self.post_id)
+        if data['is_first_post']:
+            self.nntp_subject = sys.intern(nntp_subject)
+            self.references = None
+        else:
+            self.nntp_subject = sys.intern('Re: %s' % nntp_subject)
+            self.references = sys.intern(nntp_references)
+        self.nntp_group_name = sys.intern(nntp_group_name)
+        self.article_number = None
+        self.overview = None
+
+    def __getstate__(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+class ForumSnapshot:
+    '''
+    What readers see of a forum as of one sync, never modified once
+    published. Syncs build a new snapshot off to the side and swap it in
+    with a single assignment, so a request that takes a snapshot works on
+    one consistent state of the forum without taking locks.
+
+    The posts are split in two: those in the mapped snapshot file (base,
+    a ColumnForum, or None) and those synced since it was written, which
+    are kept in memory. The latter always have the higher article numbers.
+    The base can't be changed, so posts in it that were edited or deleted
+    since are shadowed by patches, which maps their article numbers to the
+    edited post or None.
+    '''
+    __slots__ = ('version', 'description', 'first_seen', 'generation', 'base',
+                 'posts', 'post_dates', 'articles', 'article_list',
+                 'next_article', 'patches', 'msgids', 'deleted', 'stats')
+
+    def __init__(self, version, description, first_seen, generation, base,
+                 posts, post_dates, articles, article_list, next_article, patches,
+                 msgids):
+        self.version = version
+        self.description = description
+        # when the forum was first crawled, 0 if that is not known
+        self.first_seen = first_seen
+        # a value that changes whenever the posts change; it only ever
+        # grows, so it stays meaningful across restarts
+        self.generation = generation
+        self.base = base
+        # time-sorted posts since the base and a parallel array of their
+        # dates for bisecting
+        self.posts = posts
+        self.post_dates = post_dates
+        # article number to post since the base, and the sorted numbers
+        self.articles = articles
+        self.article_list = article_list
+        self.next_article = next_article
+        self.patches = patches
+        # message id to post for the posts since the base and the patched
+        # ones, None for the deleted ones (they may still be in the base)
+        self.msgids = msgids
+        # article numbers of the base posts that are gone
+        self.deleted = frozenset(number for number, post in patches.items() if post is None)
+        # article_stats(), worked out on first use
+        self.stats = None
+
+    def get_article(self, number):
+        '''Returns the post with the given article number, or None'''
+        post = self.articles.get(int(number))
+        if post is None and self.base is not None:
+            if int(number) in self.patches:
+                return self.patches[int(number)]
+            post = self.base.get_article(int(number))
+        return post
+
+    def article_range(self, start, end=None):
+        '''Returns the posts numbered start to end (inclusive), in number order'''
+        posts = []
+        if self.base is not None:
+            posts = self.base.article_range(int(start), end if end is None else int(end))
+            if self.patches:
+                posts = [self.patches.get(post.article_number, post) for post in posts]
+                posts = [post for post in posts if post is not None]
+        low = bisect.bisect_left(self.article_list, int(start))
+        if end is None:
+            numbers = self.article_list[low:]
+        else:
+            numbers = self.article_list[low:bisect.bisect_right(self.article_list, int(end))]
+        posts.extend(self.articles[number] for number in numbers)
+        return posts
+
+    def overview_range(self, start, end=None):
+        '''
+        Returns the overview lines of the posts numbered start to end
+        (inclusive), in number order, without building the base's records
+        '''
+        lines = []
+        if self.base is not None:
+            for number, line in self.base.overview_range(int(start), end if end is None else int(end)):
+                if number in self.patches:
+                    post = self.patches[number]
+                    if post is None:
+                        continue
+                    line = post.overview
+                lines.append(line)
+        low = bisect.bisect_left(self.article_list, int(start))
+        if end is None:
+            numbers = self.article_list[low:]
+        else:
+            numbers = self.article_list[low:bisect.bisect_right(self.article_list, int(end))]
+        lines.extend(self.articles[number].overview for number in numbers)
+        return lines
+
+    def article_numbers(self, start=None, end=None):
+        '''
+        Yields the article numbers in use from start to end (inclusive,
+        None for no limit), in order
+        '''
+        if self.base is not None:
+            numbers = self.base.numbers
+            low = 0 if start is None else bisect.bisect_left(numbers, int(start))
+            high = len(numbers) if end is None else bisect.bisect_right(numbers, int(end))
+            if self.deleted:
+                yield from (number for number in numbers[low:high] if number not in self.deleted)
+            else:
+                yield from numbers[low:high]
+        low = 0 if start is None else bisect.bisect_left(self.article_list, int(start))
+        high = len(self.article_list) if end is None else bisect.bisect_right(self.article_list, int(end))
+        yield from itertools.islice(self.article_list, low, high)
+
+    def article_stats(self):
+        '''Returns (count, low, high), low > high when the forum is empty'''
+        # the snapshot never changes, so neither do its stats
+        if self.stats is None:
+            self.stats = self._article_stats()
+        return self.stats
+
+    def _article_stats(self):
+        count = len(self.article_list)
+        low = high = None
+        if self.base is not None:
+            count += self.base.count - len(self.deleted)
+            for number in self.base.numbers:
+                if number not in self.deleted:
+                    low = number
+                    break
+            for number in reversed(self.base.numbers):
+                if number not in self.deleted:
+                    high = number
+                    break
+        if count == 0:
+            return (0, self.next_article, self.next_article - 1)
+        if low is None:
+            low = self.article_list[0]
+        if len(self.article_list) > 0:
+            high = self.article_list[-1]
+        return (count, low, high)
+
+    def iter_posts(self):
+        '''Yields all posts in article number order'''
+        if self.base is not None:
+            for post in self.base.records():
+                post = self.patches.get(post.article_number, post)
+                if post is not None:
+                    yield post
+        for number in self.article_list:
+            yield self.articles[number]
+
+    def posts_since(self, date):
+        '''
+        Yields the posts dated date or later, in date order. Both the base
+        and the posts since are bisected by date, and merged as they are
+        read.
+        '''
+        since = itertools.islice(self.posts, bisect.bisect_left(self.post_dates, date), None)
+        if self.base is None:
+            yield from since
+            return
+        base = (self.patches.get(post.article_number, post) for post in self.base.records_since(date))
+        base = (post for post in base if post is not None)
+        yield from heapq.merge(base, since, key=lambda post: post.post_date)
+
+    def msgids_since(self, date):
+        '''
+        Yields (date, message id) of the posts dated date or later, in
+        date order, like posts_since() but without building the base's
+        records
+        '''
+        since = ((post.post_date, post.nntp_message_id) for post in
+                 itertools.islice(self.posts, bisect.bisect_left(self.post_dates, date), None))
+        if self.base is None:
+            yield from since
+            return
+
+        def base():
+            for post_date, number, msgid in self.base.msgids_since(date):
+                if number in self.patches:
+                    post = self.patches[number]
+                    if post is None:
+                        continue
+                    msgid = post.nntp_message_id
+                yield (post_date, msgid)
+        yield from heapq.merge(base(), since, key=lambda item: item[0])
+
+    def thread_posts(self, thread_ids):
+        '''
+        Returns the posts of the given threads as a dict of thread IDs to
+        their posts in thread order. Has to go through all of the forum's
+        posts, so it is meant for the occasional thread that changed.
+        '''
+        threads = dict((thread_id, []) for thread_id in thread_ids)
+        if self.base is not None:
+            for post in self.base.thread_records(threads):
+                post = self.patches.get(post.article_number, post)
+                if post is not None:
+                    threads[post.thread_id].append(post)
+        for post in self.posts:
+            if post.thread_id in threads:
+                threads[post.thread_id].append(post)
+        for posts in threads.values():
+            posts.sort(key=lambda post: (post.post_date, post.post_id))
+        return threads
+
+class RequestBudget:
+    '''
+    A budget of API requests per hour that refills continuously (a token
+    bucket). Requests always go through and may take it below zero; the
+    sync scheduler checks what is left before it starts on a forum. With
+    per_hour 0 there is no limit, but spent still counts the requests.
+    '''
+
+    def __init__(self, per_hour):
+        self.per_hour = per_hour
+        self.tokens = per_hour
+        self.updated = time.time()
+        self.spent = 0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.per_hour, self.tokens + (now - self.updated) * self.per_hour / 3600.0)
+        self.updated = now
+
+    def spend(self, requests=1):
+        with self.lock:
+            self.spent += requests
+            if self.per_hour:
+                self._refill()
+                self.tokens -= requests
+
+    def wait_time(self, requests):
+        '''
+        Returns the seconds until requests can be made, which is never more
+        than the time it takes to refill the whole budget
+        '''
+        if not self.per_hour:
+            return 0
+        with self.lock:
+            self._refill()
+            missing = min(requests, self.per_hour) - self.tokens
+        return max(0, missing * 3600.0 / self.per_hour)
+
 # thanks https://python-3-patterns-idioms-test.readthedocs.io/en/latest/Singleton.html
 
 class Borg:
@@ -39,191 +335,1154 @@ class XenforoCommon(Borg):
         if self.initialized:
             return
             
-        self.requests_kwargs = {
-            'headers': {
-                'XF-Api-Key': api_key
-            }
-        }
+        # one session for all API calls, so connections get reused; the pool
+        # is sized to the number of workers fetching concurrently
+        self.session = requests.Session()
+        self.session.headers['XF-Api-Key'] = api_key
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=settings.xenforo_api_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.xenforo_api_concurrency)
+
         self.spool = spool
         self.api_url = api_url
+        # crawl state, only touched by the sync
         self.forums = {}
-        self.posts_by_msgid = {}
-        self.pending_attachment_ids = []
+        # what readers use: a ForumSnapshot per forum and the mapped
+        # snapshot file they are based on
+        self.snapshots = {}
+        self.columns = None
+        # attachments whose metadata is still to be fetched (a dict used as
+        # an ordered set, filled by the fetching workers under the lock), the
+        # ones fetched and their article numbers in binaries.test by ID
+        self.pending_attachment_ids = {}
         self.attachments = []
+        self.attachment_numbers = {}
+        self.attachments_lock = threading.Lock()
+        # serializes syncs, readers never take it
+        self.sync_lock = threading.Lock()
+        # rendered post bodies by (post_id, last_edit_date)
+        rendered_path = None
+        if settings.xenforo_api_body_cache_disk == 'yes':
+            rendered_path = '%s/%s' % (self.spool, 'rendered')
+        self.rendered = LRUCache(settings.xenforo_api_body_cache_size, rendered_path)
+        self.massager = Body_Massager()
+        # post bodies fetched on demand by (post_id, last_edit_date), and the
+        # fetches in flight, so concurrent reads of a post share one request
+        self.lazy_bodies = settings.xenforo_api_lazy_bodies == 'yes'
+        self.bodies = LRUCache(settings.xenforo_api_body_cache_size,
+                               '%s/%s' % (self.spool, 'bodies') if self.lazy_bodies else None)
+        self.fetching = {}
+        self.fetching_lock = threading.Lock()
+        # posts per page of a thread, XenForo's default until a page says
+        self.posts_per_page = 20
+        # sync scheduling: API requests per hour, when each forum is due to
+        # be polled next and when it last was, and the forums to poll as
+        # soon as the budget allows (asked for by GROUP, or deferred)
+        self.budget = RequestBudget(settings.xenforo_api_request_budget)
+        self.next_poll = {}
+        self.polled = {}
+        self.wanted = set()
+        self.wanted_lock = threading.Lock()
+        self.wake = threading.Event()
+        # after a failed sync, no polling before this time
+        self.retry_at = 0
 
-        data = None
-        try: 
-            with open('%s/%s' % (self.spool, 'forums.pickle'), 'rb') as f:
-                data = pickle.load(f)
-        except Exception as e:
-            print(e)
+        # snapshot file plus journal of the syncs since
+        self.store = SnapshotStore(self.spool, MEGASTRUCTURE_VERSION, Post)
+        data = self.store.load()
+        if data is not None:
+            self.forums, self.attachments, self.columns, replayed = data
+            self.attachment_numbers = dict((attachment['attachment_id'], number)
+                                           for number, attachment in enumerate(self.attachments, 1))
+            for slug in self.forums:
+                self.publish(slug, self.columns.forum(slug), [], [], {}, [], {}, {}, changed=False)
+            for slug, posts, patched, deleted in replayed:
+                self.patch_posts(slug, patched, deleted)
+                self.index_new_posts(slug, posts)
+            print("loaded forum snapshot, let's check for new stuff")
+
+        # fetch what changed while we were down (everything on the first start)
+        self.sync()
+        self.initialized = True
+
+        interval = settings.xenforo_api_sync_interval
+        if settings.xenforo_api_webhook_port:
+            self.webhooks = xenforo_webhook.start_listener(
+                self, settings.xenforo_api_webhook_address,
+                settings.xenforo_api_webhook_port, settings.xenforo_api_webhook_secret)
+            # webhooks deliver the changes, polling only catches what they missed
+            interval = settings.xenforo_api_webhook_reconcile_interval
+        if interval:
+            self.start_sync(interval)
+
+    def start_sync(self, interval):
+        '''
+        Starts a daemon thread that polls each forum every interval seconds
+        or less often, depending on how busy it is (see poll_interval())
+        '''
+        self.schedule(set(self.forums), interval)
+        thread = threading.Thread(target=self._sync_loop, args=(interval,),
+                                  name='xenforo-sync', daemon=True)
+        thread.start()
 
-        if data is not None and 'version' in data and data['version'] == MEGASTRUCTURE_VERSION:
-            self.forums = data['forums']
-            self.attachments = data['attachments']
-            print("loaded pickled forums, let's check for new stuff")
-            self.get_everything()
+    def _sync_loop(self, interval):
+        while True:
+            self.wake.wait(self.time_to_next_poll(interval))
+            self.wake.clear()
+            if time.time() < self.retry_at:
+                continue
+            due = self.due_forums()
+            if len(due) == 0:
+                continue
+            try:
+                self.sync(due)
+            except Exception as e:
+                # forums asked for stay wanted, which would retry right away
+                print("sync failed: %s, retrying in %ss" % (e, interval))
+                self.retry_at = time.time() + interval
+            self.schedule(due, interval)
+
+    def due_forums(self):
+        '''Returns the slugs of the forums to poll now'''
+        now = time.time()
+        with self.wanted_lock:
+            due = set(self.wanted)
+        due.update(slug for slug in self.forums if self.next_poll.get(slug, 0) <= now)
+        return due
+
+    def schedule(self, polled, interval):
+        '''
+        Sets when to poll the given forums next, and forums seen for the
+        first time. Forums still wanted were deferred and stay due.
+        '''
+        now = time.time()
+        with self.wanted_lock:
+            wanted = set(self.wanted)
+        for slug in self.forums:
+            if (slug in polled or slug not in self.next_poll) and slug not in wanted:
+                self.next_poll[slug] = now + self.poll_interval(slug, interval)
+
+    def time_to_next_poll(self, interval):
+        '''
+        Returns the seconds until a forum is due, or the budget allows
+        polling a wanted one, but not before a failed sync is retried
+        '''
+        with self.wanted_lock:
+            wanted = [slug for slug in self.wanted if slug in self.forums]
+        if wanted:
+            wait = self.budget.wait_time(min(self.forums[slug].get('crawl_cost', 1) for slug in wanted))
+        elif len(self.next_poll) == 0:
+            wait = interval
         else:
-            self.get_everything()
+            wait = min(self.next_poll.values()) - time.time()
+        return max(0, wait, self.retry_at - time.time())
+
+    def poll_interval(self, slug, minimum):
+        '''
+        Returns the seconds until a forum should be polled again: the time
+        it takes to get a new post at the rate it got them lately, at least
+        minimum and at most xenforo_api_sync_max_interval seconds.
+        '''
+        maximum = max(settings.xenforo_api_sync_max_interval, minimum)
+        activity = self.forums[slug].get('activity', [])
+        if len(activity) == 0:
+            return minimum
+        seen, last_post_date, message_count = activity[-1]
+        # a forum that fell silent is polled less and less often
+        interval = (time.time() - last_post_date) / 2.0
+        posts = message_count - activity[0][2]
+        if posts > 0:
+            # the posts since the oldest sample were seen came in by the
+            # newest last post date
+            interval = max(interval, max(last_post_date - activity[0][0], 1) / float(posts))
+        return min(max(interval, minimum), maximum)
+
+    def observe(self, slug, type_data):
+        '''
+        Remembers when the last few changes of a forum's last post date
+        were seen, along with the date and the post count
+        '''
+        activity = self.forums[slug].setdefault('activity', [])
+        if len(activity) > 0 and activity[-1][1] == type_data['last_post_date']:
+            return
+        activity.append((time.time(), type_data['last_post_date'], type_data['message_count']))
+        del activity[:-ACTIVITY_SAMPLES]
+
+    def request_refresh(self, slug):
+        '''
+        Has the sync scheduler poll a forum as soon as the budget allows,
+        e.g. because a client just selected it. Forums polled in the last
+        REFRESH_MIN_AGE seconds are left alone.
+        '''
+        if slug not in self.forums or time.time() - self.polled.get(slug, 0) < REFRESH_MIN_AGE:
+            return
+        with self.wanted_lock:
+            self.wanted.add(slug)
+        self.wake.set()
+
+    def sync(self, slugs=None):
+        '''
+        Fetches what changed since the last sync: forums whose last post date
+        or post count moved and, within those, threads whose last post ID or
+        reply count did. Only the new, edited and deleted posts get merged
+        into the live indexes, so the cost scales with what changed rather
+        than with the size of the board. With slugs, only those forums (and
+        new ones) are synced, within the request budget.
+        '''
+        with self.sync_lock:
+            crawled = [slug for slug in self.forums if self.forums[slug]['threads']]
+            changed = self.get_forums(slugs)
+            # edits don't show in the forum listing, look for them in a few
+            # threads of each forum polled that was crawled before
+            polled = crawled if slugs is None else [slug for slug in crawled if slug in slugs]
+            for slug in polled:
+                edited = self.recheck_edits(slug, settings.xenforo_api_edit_recheck_threads)
+                if not edited:
+                    continue
+                posts, patched, deleted, threads = changed.get(slug, ([], [], [], []))
+                seen = set(post.post_id for post in patched)
+                patched.extend(post for post in edited if post.post_id not in seen)
+                threads.extend(set(post.thread_id for post in edited) - set(threads))
+                changed[slug] = (posts, patched, deleted, threads)
+            if len(changed) == 0:
+                return
+            new_posts = {}
+            for slug, (posts, patched, deleted, threads) in changed.items():
+                self.patch_posts(slug, patched, deleted)
+                new_posts[slug] = self.index_new_posts(slug, posts)
+            attachment_count = len(self.attachments)
+            self.get_pending_attachments()
+            self.journal(changed, new_posts, self.attachments[attachment_count:])
+
+    def journal(self, changed, new_posts, attachments):
+        '''
+        Records what a sync changed in the snapshot store: the metadata of
+        the changed forums, the threads whose posts were fetched, the new
+        posts, and the edited and deleted ones. Folds the journal into the snapshot file once it grows
+        past xenforo_api_journal_max bytes, or right away when there is no
+        snapshot file yet.
+        '''
+        forums = {}
+        for slug, (posts, patched, deleted, threads) in changed.items():
+            forum = self.forums[slug]
+            meta = dict((key, value) for key, value in forum.items() if key != 'threads')
+            # threads that are gone are journaled as None
+            threads = dict((thread_id, forum['threads'].get(thread_id)) for thread_id in threads)
+            # the posts carry their article numbers and overviews by now
+            forums[slug] = (meta, threads, new_posts[slug], patched, deleted)
+        self.store.append(forums, attachments)
+
+        if self.columns is None or self.store.journal_size() > settings.xenforo_api_journal_max:
+            self.compact()
 
-        self.index_posts()
+    def compact(self):
+        '''
+        Writes all posts into a new snapshot file and bases the forums on
+        it, dropping the posts kept in memory since the last one
+        '''
+        posts = dict((slug, snapshot.iter_posts()) for slug, snapshot in self.snapshots.items())
+        self.columns = self.store.compact(self.forums, self.attachments, posts)
+        for slug in self.snapshots:
+            # the same posts, only moved into the snapshot file
+            self.publish(slug, self.columns.forum(slug), [], [], {}, [], {}, {}, changed=False)
+
+    def apply_webhook(self, payload):
+        '''
+        Applies a webhook payload: new threads are recorded, new, edited
+        and deleted posts indexed and journaled right away, and deleted
+        threads dropped with their posts. Returns False for anything else,
+        which the next reconciliation sync picks up.
+        '''
+        content_type = payload.get('content_type')
+        event = payload.get('event')
+        data = payload.get('data') or {}
+        with self.sync_lock:
+            if content_type == 'thread' and event == 'insert':
+                slug = self.forum_by_node(data.get('node_id'))
+                if slug is None:
+                    return False
+                self.update_threads(slug, [data])
+                return True
+            if content_type == 'thread' and event == 'delete':
+                return self.remove_thread(data.get('thread_id', payload.get('content_id')))
+            if content_type == 'post' and event == 'insert':
+                return self.add_post(data)
+            if content_type == 'post' and event in ('update', 'delete'):
+                # soft deleting only changes the post's state
+                deleted = event == 'delete' or data.get('message_state', 'visible') != 'visible'
+                return self.change_post(data, deleted)
+        print("webhook: leaving %s %s to the next sync" % (content_type, event))
+        return False
+
+    def forum_by_node(self, node_id):
+        '''Returns the slug of the forum with the given node ID, or None'''
+        for slug, forum in self.forums.items():
+            if forum.get('id') == node_id:
+                return slug
+        return None
+
+    def forum_of_thread(self, thread_id):
+        '''Returns the slug of the forum a known thread is in, or None'''
+        for slug, forum in self.forums.items():
+            if thread_id in forum['threads']:
+                return slug
+        return None
+
+    def add_post(self, data):
+        '''
+        Indexes a single post from a webhook. Its forum is left marked as
+        changed, so the next sync still checks it, but stops at the thread.
+        '''
+        thread_id = data.get('thread_id')
+        slug = self.forum_of_thread(thread_id)
+        if slug is None and 'Thread' in data:
+            slug = self.forum_by_node(data['Thread'].get('node_id'))
+            if slug is not None:
+                self.update_threads(slug, [data['Thread']])
+        if slug is None:
+            return False
+
+        thread = self.forums[slug]['threads'][thread_id]
+        self.queue_attachments(data)
+        post = Post(data, thread['title'], 'sgug.%s' % slug, thread['first_post_nntp_message_id'])
+        if post.post_id > thread['last_post_id']:
+            thread['last_post_id'] = post.post_id
+            thread['last_post_date'] = post.post_date
+        forum = self.forums[slug]
+        forum['last_post_id'] = max(forum.get('last_post_id', 0), post.post_id)
+
+        new_posts = self.index_new_posts(slug, [post])
+        if new_posts:
+            if not data.get('is_first_post'):
+                thread['reply_count'] += 1
+            # a post that isn't the thread's latest breaks the watermark, the
+            # next sync then compares the thread post by post
+            if post.post_id > thread['indexed_post_id']:
+                thread['post_count'] += 1
+                thread['indexed_post_id'] = post.post_id
+        attachment_count = len(self.attachments)
         self.get_pending_attachments()
-        self.dump_to_file()
-        self.initialized = True
+        self.journal({slug: ([post], [], [], [thread_id])}, {slug: new_posts},
+                     self.attachments[attachment_count:])
+        return True
+
+    def change_post(self, data, deleted):
+        '''
+        Applies an edit or deletion of a single post from a webhook.
+        Returns False for posts that aren't indexed.
+        '''
+        slug = self.forum_of_thread(data.get('thread_id'))
+        if slug is None or 'post_id' not in data or 'post_date' not in data:
+            return False
+        old = self.find_post('<%d.%d@forums.sgi.sh>' % (data['post_date'], data['post_id']))
+        if old is None or old.nntp_group_name != 'sgug.%s' % slug:
+            return False
+
+        thread = self.forums[slug]['threads'][old.thread_id]
+        if deleted:
+            patched, gone = [], [old]
+            if old.references is not None:
+                thread['reply_count'] -= 1
+            thread['post_count'] -= 1
+        else:
+            if data.get('last_edit_date', 0) <= old.last_edit_date:
+                return True
+            post = Post(data, thread['title'], old.nntp_group_name, thread['first_post_nntp_message_id'])
+            post.article_number = old.article_number
+            patched, gone = [post], []
+        self.patch_posts(slug, patched, gone)
+        self.journal({slug: ([], patched, gone, [old.thread_id])}, {slug: []}, [])
+        return True
+
+    def remove_thread(self, thread_id):
+        '''
+        Drops a deleted thread and its posts. Returns False for threads
+        that aren't known.
+        '''
+        slug = self.forum_of_thread(thread_id)
+        if slug is None:
+            return False
+        gone = self.snapshot(slug).thread_posts([thread_id])[thread_id]
+        del self.forums[slug]['threads'][thread_id]
+        self.patch_posts(slug, [], gone)
+        self.journal({slug: ([], [], gone, [thread_id])}, {slug: []}, [])
+        return True
+
+    def api_request(self, path, stream=False):
+        '''
+        GETs an API path and returns the response. Rate limited (429) and
+        unavailable (503) responses are retried up to xenforo_api_max_retries
+        times, honouring Retry-After if present and backing off exponentially
+        otherwise. With stream, the body is only read as it gets used.
+        '''
+        delay = 1
+        for attempt in range(settings.xenforo_api_max_retries + 1):
+            r = self.session.get(self.api_url + path, stream=stream,
+                                 timeout=settings.xenforo_api_timeout)
+            if r.status_code not in (429, 503):
+                break
+            r.close()
+            try:
+                wait = float(r.headers['Retry-After'])
+            except (KeyError, ValueError):
+                wait = delay
+                delay = min(delay * 2, 60)
+            print("%s: HTTP %d, retrying in %ss" % (path, r.status_code, wait))
+            time.sleep(wait)
+        self.budget.spend(attempt + 1)
+        r.raise_for_status()
+        return r
+
+    def api_get(self, path):
+        '''GETs an API path and returns the decoded JSON response'''
+        return json.loads(self.api_request(path).text)
+
+    def api_get_data(self, path, chunk_size=65536):
+        '''
+        GETs an API path returning binary data, such as an attachment's,
+        and yields it in chunks as it arrives
+        '''
+        r = self.api_request(path, stream=True)
+        try:
+            yield from r.iter_content(chunk_size)
+        finally:
+            r.close()
+
+    def queue_attachments(self, post):
+        '''Queues a post's attachments for get_pending_attachments()'''
+        with self.attachments_lock:
+            for att in post.get('Attachments', []):
+                if att['attachment_id'] not in self.attachment_numbers:
+                    self.pending_attachment_ids[att['attachment_id']] = True
+
+    def get_attachment(self, attachment_id):
+        '''Returns the metadata of an attachment, or None if it can't be had'''
+        try:
+            return self.api_get('/attachments/%s' % attachment_id)['attachment']
+        except requests.exceptions.RequestException as e:
+            print("attachment %s: %s" % (attachment_id, e))
+            return None
 
     def get_pending_attachments(self):
-        print("fetching attachment metadata...")
-
-        for attid in self.pending_attachment_ids:
-            r = requests.get(self.api_url + ('/attachments/%s' % attid), **self.requests_kwargs)
-            data = json.loads(r.text)
-            self.attachments.append(data['attachment'])
-            self.pending_attachment_ids.remove(attid)
-
-    def index_posts(self):
-        print("indexing starting...")
-
-        self.posts_by_msgid = {}
-
-        for forum in self.forums:
-            # time-sorted array of all posts on this forum
-            self.forums[forum]['posts'] = []
-            allposts = []
-            for thread in self.forums[forum]['threads']:
-                allposts.extend(self.forums[forum]['threads'][thread]['posts'])
-            allposts.sort(key=lambda item: item['post_date'])
-            self.forums[forum]['posts'] = allposts
-
-            # global dict with message id as key
-            for post in self.forums[forum]['posts']:
-                self.posts_by_msgid[post['nntp_message_id']] = post
-            print("%s: indexed %d posts"  % (forum, len(self.forums[forum]['posts'])))
-
-    def dump_to_file(self):
-        with open('%s/%s' % (self.spool, '/forums.pickle'), 'wb') as f:
-            pickle.dump({
-                'version': MEGASTRUCTURE_VERSION,
-                'forums': self.forums,
-                'attachments': self.attachments
-            }, f)
-            print("dumped forums as pickle")
-
-    def get_everything(self):
-        self.get_forums()
-
-    def get_forums(self, with_threads=True):
-        r = requests.get(self.api_url + '/nodes/flattened', **self.requests_kwargs)
-        data = json.loads(r.text)
+        '''
+        Fetches the metadata of the queued attachments, concurrently, and
+        numbers them in the order they were queued. Failed fetches stay
+        queued for the next sync.
+        '''
+        with self.attachments_lock:
+            pending = [attachment_id for attachment_id in self.pending_attachment_ids
+                       if attachment_id not in self.attachment_numbers]
+            self.pending_attachment_ids = {}
+        if len(pending) == 0:
+            return
+        print("fetching metadata of %d attachments..." % len(pending))
+
+        for attachment_id, attachment in zip(pending, self.executor.map(self.get_attachment, pending)):
+            if attachment is None:
+                with self.attachments_lock:
+                    self.pending_attachment_ids[attachment_id] = True
+                continue
+            # readers find the attachment by number before they find it by ID
+            self.attachments.append(attachment)
+            self.attachment_numbers[attachment_id] = len(self.attachments)
+
+    def index_new_posts(self, slug, posts):
+        '''
+        Merges freshly fetched posts into a forum's indexes and returns the
+        ones that were new. posts may include posts that are already indexed
+        (a changed thread is fetched as a whole); only the ones above the
+        forum's high-water mark or not indexed yet get inserted, at the
+        position bisect finds for their date, i.e. in O(k log n) comparisons
+        for k new posts.
+        '''
+        forum = self.forums[slug]
+        high_water = forum.get('indexed_post_id', 0)
+        # copy-on-write: the published snapshot stays untouched until the new
+        # one replaces it. Copying the lists and dict is a C-level copy of
+        # references; the per-post work still only scales with new posts.
+        old = self.snapshots.get(slug)
+        if old is None:
+            base = None
+            allposts, post_dates, articles, article_list, patches = [], [], {}, [], {}
+            msgids = {}
+        else:
+            base = old.base
+            allposts = list(old.posts)
+            post_dates = list(old.post_dates)
+            articles = dict(old.articles)
+            article_list = list(old.article_list)
+            patches = old.patches
+            msgids = dict(old.msgids)
+
+        new_posts = [post for post in posts
+                     if post.post_id > high_water or
+                        not self.is_indexed(post)]
+        new_posts.sort(key=lambda item: item.post_date)
+        self.number_posts(slug, new_posts)
+
+        for post in new_posts:
+            self.build_overview(post)
+            self.trim_post(post)
+            # new posts usually sort last, which makes this an append
+            if len(post_dates) == 0 or post.post_date >= post_dates[-1]:
+                allposts.append(post)
+                post_dates.append(post.post_date)
+            else:
+                position = bisect.bisect_right(post_dates, post.post_date)
+                allposts.insert(position, post)
+                post_dates.insert(position, post.post_date)
+            number = post.article_number
+            articles[number] = post
+            if len(article_list) == 0 or number > article_list[-1]:
+                article_list.append(number)
+            else:
+                bisect.insort(article_list, number)
+            msgids[post.nntp_message_id] = post
+            if post.post_id > high_water:
+                high_water = post.post_id
+
+        forum['indexed_post_id'] = high_water
+        self.publish(slug, base, allposts, post_dates, articles, article_list, patches,
+                     msgids, changed=len(new_posts) > 0)
+        print("%s: indexed %d new posts" % (slug, len(new_posts)))
+        return new_posts
+
+    def is_indexed(self, post):
+        '''
+        Whether the post is indexed where it is now. A post that moved to
+        another thread or forum counts as new there.
+        '''
+        indexed = self.find_post(post.nntp_message_id)
+        return (indexed is not None and
+                indexed.nntp_group_name == post.nntp_group_name and
+                indexed.thread_id == post.thread_id)
+
+    def patch_posts(self, slug, patched, deleted):
+        '''
+        Replaces edited posts in a forum's indexes by their new version
+        (carrying the old article number) and removes deleted ones, leaving
+        their article numbers unused. Posts in the base are shadowed by
+        entries in the snapshot's patches until the next compaction. Drops
+        the bodies cached for the old versions.
+        '''
+        if not patched and not deleted:
+            return
+        old = self.snapshots[slug]
+        allposts = list(old.posts)
+        post_dates = list(old.post_dates)
+        articles = dict(old.articles)
+        article_list = list(old.article_list)
+        patches = dict(old.patches)
+        msgids = dict(old.msgids)
+
+        def position(post):
+            # where an in-memory post is in the time-sorted list
+            index = bisect.bisect_left(post_dates, post.post_date)
+            while allposts[index].post_id != post.post_id:
+                index += 1
+            return index
+
+        for post in patched:
+            self.build_overview(post)
+            self.trim_post(post)
+            previous = old.get_article(post.article_number)
+            if previous is not None:
+                self.forget_bodies(previous)
+            if post.article_number in articles:
+                allposts[position(articles[post.article_number])] = post
+                articles[post.article_number] = post
+            else:
+                patches[post.article_number] = post
+            msgids[post.nntp_message_id] = post
+
+        for post in deleted:
+            self.forget_bodies(post)
+            if post.article_number in articles:
+                index = position(articles.pop(post.article_number))
+                del allposts[index]
+                del post_dates[index]
+                del article_list[bisect.bisect_left(article_list, post.article_number)]
+            else:
+                patches[post.article_number] = None
+            # unless the post reappeared somewhere else under its message id
+            indexed = msgids.get(post.nntp_message_id)
+            if indexed is None or (indexed.nntp_group_name == post.nntp_group_name and
+                                   indexed.article_number == post.article_number):
+                msgids[post.nntp_message_id] = None
+
+        self.publish(slug, old.base, allposts, post_dates, articles, article_list, patches,
+                     msgids)
+        print("%s: patched %d edited and %d deleted posts" % (slug, len(patched), len(deleted)))
+
+    def forget_bodies(self, post):
+        '''Drops the cached bodies of a post'''
+        key = (post.post_id, post.last_edit_date)
+        self.rendered.discard(key)
+        self.bodies.discard(key)
+
+    def publish(self, slug, base, posts, post_dates, articles, article_list, patches,
+                msgids, changed=True):
+        '''
+        Makes a new snapshot of a forum visible to readers, message ids
+        included, so a lookup never sees posts the snapshot doesn't have
+        yet or lost ones it still has. changed says
+        whether its posts differ from the last one's, which moves the
+        forum's generation on.
+        '''
+        forum = self.forums[slug]
+        old = self.snapshots.get(slug)
+        # the generation is journaled with the forum and only ever grows. It
+        # starts from the clock, so a new spool doesn't reuse generations the
+        # response cache may still have entries for.
+        if 'generation' not in forum:
+            forum['generation'] = int(time.time() * 1000)
+        elif changed:
+            forum['generation'] += 1
+        snapshot = ForumSnapshot(
+            version=old.version + 1 if old is not None else 1,
+            description=forum['description'],
+            first_seen=forum.get('first_seen', 0),
+            generation=forum['generation'],
+            base=base,
+            posts=posts,
+            post_dates=post_dates,
+            articles=articles,
+            article_list=article_list,
+            next_article=forum.get('next_article', 1),
+            patches=patches,
+            msgids=msgids)
+        if old is not None:
+            # replacing the value of an existing key is a single store
+            self.snapshots[slug] = snapshot
+        else:
+            # readers may be iterating over self.snapshots, so add new
+            # forums to a copy and swap it in
+            snapshots = dict(self.snapshots)
+            snapshots[slug] = snapshot
+            self.snapshots = snapshots
+
+    def snapshot(self, slug):
+        '''Returns the current snapshot of a forum, or None'''
+        return self.snapshots.get(slug)
+
+    def find_post(self, msgid):
+        '''Returns the post with the given message id, or None'''
+        found = False
+        for snapshot in list(self.snapshots.values()):
+            if msgid in snapshot.msgids:
+                post = snapshot.msgids[msgid]
+                # a post that moved is deleted in one forum and indexed
+                # in another
+                if post is not None:
+                    return post
+                found = True
+        if found or self.columns is None:
+            return None
+        match = re.match(r'<\d+\.(\d+)@', msgid)
+        if match is None:
+            return None
+        post = self.columns.find(int(match.group(1)))
+        if post is None or post.nntp_message_id != msgid:
+            return None
+        return post
+
+    def number_posts(self, slug, posts):
+        '''
+        Allocates the next free article numbers of the forum to posts that
+        have none yet. Numbers are handed out append-only and stored with
+        the posts, so a post keeps its number across syncs and restarts
+        (refetched posts are replaced by their indexed records) and the
+        numbers of posts that go away are never reused.
+        '''
+        forum = self.forums[slug]
+        for post in posts:
+            if post.article_number is None:
+                post.article_number = forum.get('next_article', 1)
+                forum['next_article'] = post.article_number + 1
+
+    def build_overview(self, post):
+        '''
+        Sets post.overview to the post's XOVER line, with the real size
+        of the article and line count of its body. Kept in the snapshot, so
+        each post is only rendered for this once; the rendering goes into
+        the body cache for the first read.
+        '''
+        if post.overview is not None:
+            return
+        body = self.massager.massage({'message': post.message})
+        self.rendered.put((post.post_id, post.last_edit_date), body)
+        lines = body.splitlines()
+        # the article as do_ARTICLE sends it: headers, blank line and body
+        # as they are, with the CRLFs around the body, in latin-1
+        article = "%s\r\n\r\n%s\r\n" % (self.create_usenet_headers(post, None), body)
+        size = len(bytes(article, 'latin-1', 'replace'))
+        # message_number <tab> subject <tab> author <tab> date <tab> message_id <tab> reference <tab> bytes <tab> lines <tab> xref
+        post.overview = "\t".join([
+            str(post.article_number),
+            overview_field(post.nntp_subject),
+            overview_field(post.username),
+            strutil.get_formatted_time(time.localtime(post.post_date)),
+            post.nntp_message_id,
+            post.references or '',
+            str(size),
+            str(len(lines)),
+            'Xref: %s %s:%s' % (settings.nntp_hostname, post.nntp_group_name, post.article_number)
+        ])
+
+    def trim_post(self, post):
+        '''Drops the body of a post with lazy bodies'''
+        if self.lazy_bodies:
+            post.message = None
+
+    def get_message(self, post):
+        '''
+        Returns the bbcode of a post, fetching it from the forum if it was
+        dropped by trim_post().
+        '''
+        if post.message is not None:
+            return post.message
+
+        key = (post.post_id, post.last_edit_date)
+        message = self.bodies.get(key)
+        if message is not None:
+            return message
+
+        with self.fetching_lock:
+            future = self.fetching.get(key)
+            fetch = future is None
+            if fetch:
+                future = Future()
+                self.fetching[key] = future
+        if not fetch:
+            return future.result()
+
+        try:
+            message = self.api_get('/posts/%d' % post.post_id)['post']['message']
+            self.bodies.put(key, message)
+            future.set_result(message)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.fetching_lock:
+                del self.fetching[key]
+        return message
+
+    def generation(self, slug=None):
+        '''
+        Returns a value that changes whenever the forum's indexed posts change
+        (or those of any forum if slug is None).
+        '''
+        if slug is not None:
+            return self.snapshots[slug].generation
+        # an edit only moves the generation of its own forum
+        return sum(snapshot.generation or 0 for snapshot in self.snapshots.values())
+
+    def get_forums(self, slugs=None, with_threads=True):
+        '''
+        Fetches forums whose last post date or post count changed. Returns a
+        dict mapping their slugs to what get_threads_from_forum() found.
+        With slugs, other forums that changed are left for when they are
+        due, and forums are only fetched while the request budget lasts,
+        the ones asked for first, then the busiest; the rest is deferred.
+        '''
+        now = time.time()
+        changed = {}
+        candidates = []
+        data = self.api_get('/nodes/flattened')
         for node in data['nodes_flat']:
             if node['node']['node_type_id'] != 'Forum':
                 continue
             slug = slugify(node['node']['title'])
+            type_data = node['node']['type_data']
 
             if slug in self.forums:
-                # bail out and do not touch anything if nothing seems to have changed
-                if self.forums[slug]['last_post_date'] == node['node']['type_data']['last_post_date']:
+                self.observe(slug, type_data)
+                # bail out and do not touch anything if nothing seems to have
+                # changed; deleting a post only changes the post count
+                if (self.forums[slug].get('last_post_date') == type_data['last_post_date'] and
+                    self.forums[slug].get('message_count') == type_data['message_count']):
                     print("forum %s up to date, skipping" % slug)
+                    self.polled[slug] = now
+                    with self.wanted_lock:
+                        self.wanted.discard(slug)
+                    continue
+                if slugs is not None and slug not in slugs:
                     continue
             else:
-                self.forums[slug] = {}
+                # for NEWGROUPS
+                self.forums[slug] = {'threads': {}, 'first_seen': now}
+                self.observe(slug, type_data)
+            candidates.append((slug, node))
 
-            self.forums[slug]['threads'] = {}
-            self.forums[slug]['id'] = node['node']['node_id']
-            self.forums[slug]['description'] = node['node']['description']
-            self.forums[slug]['message_count'] = node['node']['type_data']['message_count']
-            self.forums[slug]['last_post_date'] = node['node']['type_data']['last_post_date']
-            self.forums[slug]['last_post_id'] = node['node']['type_data']['last_post_id']
-            self.forums[slug]['posts'] = []
+        if slugs is not None:
+            with self.wanted_lock:
+                wanted = set(self.wanted)
+            candidates.sort(key=lambda candidate: (candidate[0] not in wanted,
+                                                   self.poll_interval(candidate[0], 0)))
 
+        for slug, node in candidates:
+            forum = self.forums[slug]
+            type_data = node['node']['type_data']
+            if slugs is not None and 'crawl_cost' in forum and self.budget.wait_time(forum['crawl_cost']) > 0:
+                print("forum %s changed, deferred until the request budget allows" % slug)
+                with self.wanted_lock:
+                    self.wanted.add(slug)
+                continue
+
+            forum['id'] = node['node']['node_id']
+            forum['description'] = node['node']['description']
+
+            found = ([], [], [], [])
             if with_threads:
                 print("fetching threads for %s" % slug)
-                self.get_threads_from_forum(slug)
-
-    def get_threads_r(self, slug, page):
-        forum_id = self.forums[slug]['id']
-        r = requests.get('%s/forums/%d&page=%d&with_threads=1' % (self.api_url, forum_id, page),
-                         **self.requests_kwargs)
-
-        data = json.loads(r.text)
-        for thread in data['threads']:
-            # bail out and do not touch posts if nothing seems to have changed
-            if (thread['thread_id'] in self.forums[slug]['threads'] and
-                thread['last_post_id'] <= self.forums[slug]['threads'][thread['thread_id']]['last_post_id']):
-                return
-            else:
-                self.forums[slug]['threads'][thread['thread_id']] = {
-                    'title': thread['title'],
-                    'last_post_date': thread['last_post_date'],
-                    'last_post_id': thread['last_post_id'],
-                    'first_post_nntp_message_id': '<%d.%d@forums.sgi.sh>' % (thread['post_date'], thread['first_post_id']),
-                    'posts': []
-                }
-
-        if data['pagination']['last_page'] > page:
-            self.get_threads_r(slug, page + 1)
-        else:
-            # no more threads to fetch, let's empty the forum's time-sorted post array
-            # and figure out which posts to find.
-            print("fetching posts for %s" % (slug))
-            for thread_id, thread in self.forums[slug]['threads'].items():
-                # bail out and do not touch posts if nothing seems to have changed
-                if (thread['last_post_id'] <= self.forums[slug]['threads'][thread_id]['last_post_id'] and
-                    len(self.forums[slug]['threads'][thread_id]['posts']) > 0):
+                incremental = len(forum['threads']) > 0
+                spent = self.budget.spent
+                found = self.get_threads_from_forum(slug, type_data['message_count'])
+                # what a sync of the forum usually takes, to plan with the budget
+                if incremental:
+                    cost = self.budget.spent - spent
+                    forum['crawl_cost'] = (forum.get('crawl_cost', cost) + cost) / 2.0
+
+            # only record the new state once the threads are in, so a failed
+            # fetch gets retried on the next sync
+            forum['message_count'] = type_data['message_count']
+            forum['last_post_date'] = type_data['last_post_date']
+            forum['last_post_id'] = type_data['last_post_id']
+            self.polled[slug] = now
+            with self.wanted_lock:
+                self.wanted.discard(slug)
+            changed[slug] = found
+        return changed
+
+    def recheck_edits(self, slug, count):
+        '''
+        Fetches the newest page of count of the forum's threads, taking
+        turns through all of them across polls, and returns the posts on
+        them that were edited since they were indexed, carrying their old
+        article numbers. The forum listing only moves on new posts, so
+        edits would otherwise only be seen through webhooks. Stays within
+        the request budget.
+        '''
+        forum = self.forums[slug]
+        thread_ids = sorted((thread_id for thread_id, thread in forum['threads'].items()
+                             if thread['post_count'] > 0), reverse=True)
+        if count <= 0 or len(thread_ids) == 0 or self.budget.wait_time(min(count, len(thread_ids))) > 0:
+            return []
+        start = forum.get('recheck_position', 0) % len(thread_ids)
+        chosen = (thread_ids[start:] + thread_ids[:start])[:count]
+        forum['recheck_position'] = start + len(chosen)
+
+        def newest_page(thread_id):
+            thread = forum['threads'][thread_id]
+            page = (thread['post_count'] - 1) // self.posts_per_page + 1
+            return (thread, self.get_post_page(thread_id, page))
+
+        edited = []
+        for thread, data in self.executor.map(newest_page, chosen):
+            for post_data in data['posts']:
+                old = self.find_post('<%d.%d@forums.sgi.sh>' % (post_data['post_date'], post_data['post_id']))
+                if (old is None or old.nntp_group_name != 'sgug.%s' % slug or
+                    post_data.get('last_edit_date', 0) <= old.last_edit_date):
                     continue
-                self.forums[slug]['threads'][thread_id]['posts'].extend(self.get_posts_r(
+                post = Post(post_data, thread['title'], old.nntp_group_name, thread['first_post_nntp_message_id'])
+                post.article_number = old.article_number
+                edited.append(post)
+        if edited:
+            print("%s: found %d edited posts in %d threads" % (slug, len(edited), len(chosen)))
+        return edited
+
+    def get_thread_page(self, slug, page):
+        return self.api_get('/forums/%d&page=%d&with_threads=1&order=last_post_date&direction=desc' % (
+            self.forums[slug]['id'], page))
+
+    def update_threads(self, slug, threads, watermark=None):
+        '''
+        Records new and changed threads: those with a new last post, and
+        those whose reply count changed without one, i.e. that lost posts or
+        had some moved in. The listing is ordered by last post date, so with
+        a watermark (the forum's last post date as of the last sync) it
+        returns False once it reaches a thread whose last post is older,
+        i.e. when no further page can have changed threads.
+        '''
+        known_threads = self.forums[slug]['threads']
+        for thread in threads:
+            if watermark is not None and thread['last_post_date'] < watermark:
+                return False
+            known = known_threads.get(thread['thread_id'])
+            reply_count = thread.get('reply_count', 0)
+            if known is not None and thread['last_post_id'] <= known['last_post_id']:
+                if reply_count != known['reply_count']:
+                    known['reply_count'] = reply_count
+                    known['fetched'] = False
+                continue
+            known_threads[thread['thread_id']] = {
+                'title': thread['title'],
+                'last_post_date': thread['last_post_date'],
+                'last_post_id': thread['last_post_id'],
+                'first_post_nntp_message_id': '<%d.%d@forums.sgi.sh>' % (thread['post_date'], thread['first_post_id']),
+                'reply_count': reply_count,
+                # whether the posts were fetched since the thread changed
+                'fetched': False,
+                # the thread's high-water mark: how many of its posts are
+                # indexed and the ID of the last one
+                'post_count': known['post_count'] if known is not None else 0,
+                'indexed_post_id': known['indexed_post_id'] if known is not None else 0
+            }
+        return True
+
+    def iter_thread_pages(self, slug, concurrent=False):
+        '''
+        Yields the forum's thread listing page by page. With concurrent set
+        the pages after the first one are fetched on the worker pool.
+        '''
+        data = self.get_thread_page(slug, 1)
+        yield data
+        pages = range(2, data['pagination']['last_page'] + 1)
+        if concurrent:
+            yield from self.executor.map(lambda p: self.get_thread_page(slug, p), pages)
+        else:
+            for page in pages:
+                yield self.get_thread_page(slug, page)
+
+    def listed_count(self, slug):
+        '''The forum's post count as its threads' reply counts add up to'''
+        forum = self.forums[slug]
+        return (sum(thread['reply_count'] + 1 for thread in forum['threads'].values()) +
+                forum.get('count_offset', 0))
+
+    def get_threads_from_forum(self, slug, message_count):
+        '''
+        Fetches the threads of a forum that changed and their posts. Returns
+        (posts, patched, deleted, thread IDs): the posts fetched, which
+        index_new_posts() sorts out, the edited and the deleted posts, and
+        the threads that changed.
+        '''
+        forum = self.forums[slug]
+        # without any known threads there is no watermark to stop at, so all
+        # pages can be fetched concurrently
+        full_crawl = len(forum['threads']) == 0
+        watermark = None if full_crawl else forum.get('last_post_date')
+
+        for data in self.iter_thread_pages(slug, full_crawl):
+            # sticky threads come separately and out of order
+            self.update_threads(slug, data.get('sticky', []))
+            # stop paging at the watermark, but still fetch the posts of the
+            # changed threads seen so far
+            if not self.update_threads(slug, data['threads'], watermark):
+                break
+
+        gone = []
+        if not full_crawl and self.listed_count(slug) != message_count:
+            # posts went away somewhere below the watermark, or whole threads
+            # did: go through the whole listing
+            print("%s: post count is off, checking all threads" % slug)
+            listed = set()
+            for data in self.iter_thread_pages(slug, True):
+                for threads in (data.get('sticky', []), data['threads']):
+                    self.update_threads(slug, threads)
+                    listed.update(thread['thread_id'] for thread in threads)
+            # the listing may have shifted while we paged through it
+            gone = [thread_id for thread_id in forum['threads']
+                    if thread_id not in listed and self.thread_gone(slug, thread_id)]
+        # XenForo's count need not match the listing exactly (e.g. with
+        # moderated posts); remember by how much it is off
+        forum['count_offset'] = 0
+        forum['count_offset'] = message_count - self.listed_count(slug)
+
+        # no more threads to fetch, let's figure out which posts to find.
+        print("fetching posts for %s" % (slug))
+        pending = [thread_id for thread_id, thread in forum['threads'].items()
+                   if not thread['fetched'] and thread_id not in gone]
+        posts, patched, deleted = [], [], []
+
+        # threads that only got new posts just need the pages past their
+        # watermark
+        appended = [thread_id for thread_id in pending
+                    if forum['threads'][thread_id]['post_count'] > 0 and
+                       0 < forum['threads'][thread_id]['indexed_post_id'] < forum['threads'][thread_id]['last_post_id']]
+        compare = [thread_id for thread_id in pending if thread_id not in appended]
+        for thread_id, thread_posts in zip(appended, self.executor.map(
+                lambda thread_id: self.fetch_new_posts(slug, thread_id), appended)):
+            if thread_posts is None:
+                compare.append(thread_id)
+            else:
+                posts.extend(thread_posts)
+
+        # the others are compared with what we have of them
+        known = {}
+        snapshot = self.snapshots.get(slug)
+        refetched = [thread_id for thread_id in compare + gone if forum['threads'][thread_id]['post_count'] > 0]
+        if snapshot is not None and refetched:
+            known = snapshot.thread_posts(refetched)
+        for thread_id in gone:
+            deleted.extend(known.get(thread_id, []))
+            del forum['threads'][thread_id]
+
+        # threads are fetched concurrently, each one's pages in order
+        for thread_posts, thread_patched, thread_deleted in self.executor.map(
+                lambda thread_id: self.fetch_thread(slug, thread_id, known.get(thread_id, [])), compare):
+            posts.extend(thread_posts)
+            patched.extend(thread_patched)
+            deleted.extend(thread_deleted)
+        return (posts, patched, deleted, pending + gone)
+
+    def thread_gone(self, slug, thread_id):
+        '''Whether a thread was deleted or moved out of the forum'''
+        try:
+            data = self.api_get('/threads/%d' % thread_id)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code in (403, 404):
+                return True
+            raise
+        thread = data['thread']
+        return (thread['node_id'] != self.forums[slug]['id'] or
+                thread.get('discussion_state', 'visible') != 'visible')
+
+    def fetch_new_posts(self, slug, thread_id):
+        '''
+        Fetches the posts of a thread past its watermark, starting at the
+        page that holds the last post indexed. Returns them, or None if the
+        thread got more than new posts: the last post indexed isn't where it
+        was, or the posts don't add up to the thread's reply count. Such a
+        thread has to be compared post by post.
+        '''
+        thread = self.forums[slug]['threads'][thread_id]
+        count = thread['post_count']
+        first = (count - 1) // self.posts_per_page + 1
+        offset = (first - 1) * self.posts_per_page
+        posts = []
+        anchored = False
+        for index, post in enumerate(self.iter_posts(
+                thread_id=thread_id,
+                nntp_subject=thread['title'],
+                nntp_group_name='sgug.%s' % slug,
+                nntp_references=thread['first_post_nntp_message_id'],
+                page=first)):
+            if offset + index == count - 1:
+                anchored = post.post_id == thread['indexed_post_id']
+            elif offset + index >= count:
+                posts.append(post)
+        if not anchored or count + len(posts) != thread['reply_count'] + 1:
+            print("thread %d changed beyond new posts, comparing" % thread_id)
+            return None
+        thread['post_count'] = count + len(posts)
+        if len(posts) > 0:
+            thread['indexed_post_id'] = posts[-1].post_id
+        thread['fetched'] = True
+        return posts
+
+    def fetch_thread(self, slug, thread_id, known):
+        '''
+        Fetches the posts of a thread that changed and works out what
+        happened to the ones indexed before, known (in thread order). Pages
+        that still hold what they held before are skipped: only the pages
+        from the first one that differs on are fetched, found by bisecting,
+        as a post going away shifts all pages after it. Returns (posts,
+        patched, deleted): the posts new to the thread, the edited ones,
+        carrying their old article numbers, and the ones that are gone.
+        '''
+        thread = self.forums[slug]['threads'][thread_id]
+        pages = {}
+
+        def page(number):
+            if number not in pages:
+                pages[number] = self.get_post_page(thread_id, number)
+            return pages[number]
+
+        def unchanged(number):
+            data = page(number)
+            per_page = data['pagination'].get('per_page') or len(page(1)['posts'])
+            expected = known[(number - 1) * per_page:number * per_page]
+            return [post['post_id'] for post in data['posts']] == [post.post_id for post in expected]
+
+        first = 1
+        if known and unchanged(1):
+            low, high = 2, page(1)['pagination']['last_page'] + 1
+            while low < high:
+                middle = (low + high) // 2
+                if unchanged(middle):
+                    low = middle + 1
+                else:
+                    high = middle
+            first = low
+        per_page = page(1)['pagination'].get('per_page') or len(page(1)['posts'])
+
+        posts, patched, seen = [], [], []
+        if first <= page(1)['pagination']['last_page']:
+            indexed = dict((post.post_id, post) for post in known)
+            for post in self.iter_posts(
                     thread_id=thread_id,
-                    page=1,
                     nntp_subject=thread['title'],
                     nntp_group_name='sgug.%s' % slug,
-                    nntp_references=thread['first_post_nntp_message_id']
-                ))
-
-
-    def get_threads_from_forum(self, slug):
-        self.get_threads_r(slug, 1)
-
-    def get_posts_r(self, thread_id, page, nntp_subject, nntp_group_name, nntp_references, posts=[]):
-        ret = []
-        r = requests.get('%s/threads/%d/posts&page=%d' % (self.api_url, thread_id, page),
-                         **self.requests_kwargs)
-        data = json.loads(r.text)
-        for post in data['posts']:
-            post['nntp_message_id'] = '<%d.%d@forums.sgi.sh>' % (post['post_date'], post['post_id'])
-            if post['is_first_post']:
-                post['nntp_subject'] = nntp_subject
-                post['references'] = None
-            else:
-                post['nntp_subject'] = 'Re: %s' % nntp_subject
-                post['references'] = nntp_references
+                    nntp_references=thread['first_post_nntp_message_id'],
+                    page=first,
+                    fetched=pages):
+                seen.append(post.post_id)
+                old = indexed.get(post.post_id)
+                if old is None:
+                    posts.append(post)
+                elif post.last_edit_date > old.last_edit_date:
+                    post.article_number = old.article_number
+                    patched.append(post)
+        kept = known[:(first - 1) * per_page]
+        seen_ids = set(seen)
+        deleted = [post for post in known[(first - 1) * per_page:] if post.post_id not in seen_ids]
 
-            post['nntp_group_name'] = nntp_group_name
+        # the new high-water mark
+        thread['post_count'] = len(kept) + len(seen)
+        if len(seen) > 0:
+            thread['indexed_post_id'] = seen[-1]
+        elif len(kept) > 0:
+            thread['indexed_post_id'] = kept[-1].post_id
+        thread['fetched'] = True
+        return (posts, patched, deleted)
 
-            if 'Attachments' in post:
-                for att in post['Attachments']:
-                    if att['attachment_id'] not in self.attachments:
-                        self.pending_attachment_ids.append(att['attachment_id'])
+    def get_post_page(self, thread_id, page):
+        data = self.api_get('/threads/%d/posts&page=%d' % (thread_id, page))
+        self.posts_per_page = data['pagination'].get('per_page', self.posts_per_page)
+        return data
 
-            ret.append(post)
+    def iter_posts(self, thread_id, nntp_subject, nntp_group_name, nntp_references, page=1, fetched=None):
+        '''
+        Yields a thread's posts starting at page, fetching one page at a time
+        unless it is in fetched (a dict of page numbers to pages) already
+        '''
+        while True:
+            if fetched is not None and page in fetched:
+                data = fetched[page]
+            else:
+                data = self.get_post_page(thread_id, page)
+            for post in data['posts']:
+                self.queue_attachments(post)
+                yield Post(post, nntp_subject, nntp_group_name, nntp_references)
 
-        if data['pagination']['last_page'] > page:
-            return ret + self.get_posts_r(thread_id, page + 1, nntp_subject, nntp_group_name, nntp_references, posts)
-        return ret
+            if data['pagination']['last_page'] <= page:
+                return
+            page += 1
 
     def create_usenet_headers(self, post, id):
         headers = []
         headers.append("Path: %s" % (settings.nntp_hostname))
-        headers.append("From: %s" % (post['username']))
-        headers.append("Newsgroups: %s" % (post['nntp_group_name']))
-        headers.append("Date: %s" % (strutil.get_formatted_time(time.localtime(post['post_date']))))
-        headers.append("Subject: %s" % (post['nntp_subject']))
-        headers.append("Message-ID: %s" % (post['nntp_message_id']))
-        # easiest.
-        #
-        headers.append("Xref: %s %s:%s" % (settings.nntp_hostname, post['nntp_group_name'], id))
-        if post['references']:
-            headers.append("References: %s" % post['references'])
+        headers.append("From: %s" % (post.username))
+        headers.append("Newsgroups: %s" % (post.nntp_group_name))
+        headers.append("Date: %s" % (strutil.get_formatted_time(time.localtime(post.post_date))))
+        headers.append("Subject: %s" % (post.nntp_subject))
+        headers.append("Message-ID: %s" % (post.nntp_message_id))
+        headers.append("Xref: %s %s:%s" % (settings.nntp_hostname, post.nntp_group_name, post.article_number))
+        if post.references:
+            headers.append("References: %s" % post.references)
         return "\r\n".join(headers)
 
     def format_message(self, post):
-        massager = Body_Massager()
-        return massager.massage(post)
+        # an edit changes last_edit_date, so stale renderings are never hit
+        key = (post.post_id, post.last_edit_date)
+        body = self.rendered.get(key)
+        if body is None:
+            body = self.massager.massage({'message': self.get_message(post)})
+            self.rendered.put(key, body)
+        return body
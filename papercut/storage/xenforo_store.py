@@ -0,0 +1,357 @@
+import array
+import bisect
+import mmap
+import os
+import pickle
+import sys
+
+MAGIC = b'PCXFSNAP'
+
+# string columns use this index for None
+NONE = 0xffffffff
+
+# one row per post, grouped by forum and sorted by article number within
+# a forum; string columns hold indexes into the string table
+INT_COLUMNS = ('article_number', 'post_id', 'thread_id', 'post_date', 'last_edit_date')
+STRING_COLUMNS = ('nntp_message_id', 'nntp_subject', 'username', 'nntp_group_name',
+                  'references', 'overview', 'message')
+
+
+class SnapshotStore:
+    '''
+    Keeps the state of a XenForo forum on disk as a snapshot file plus an
+    append-only journal of what each sync changed. Syncs only append their
+    changes; once the journal grows past a limit it is folded into a new
+    snapshot, written to a temporary file and renamed over the old one so
+    a crash never leaves a half-written snapshot behind.
+
+    Every journal record carries a sequence number and the snapshot the
+    number of the last record folded into it, so records that survive a
+    crash between writing the snapshot and truncating the journal are
+    skipped on replay.
+    '''
+
+    def __init__(self, path, version, record_class):
+        self.base = os.path.join(path, 'forums.snapshot')
+        self.journal = os.path.join(path, 'forums.journal')
+        self.version = version
+        self.record_class = record_class
+        self.seq = 0
+
+    def load(self):
+        '''
+        Returns (forums, attachments, columns, replayed) as of the last
+        journaled sync, or None if there is no usable snapshot. columns is
+        the mapped ColumnSnapshot, replayed lists (slug, posts) for the
+        posts journaled since it was written.
+        '''
+        try:
+            columns = ColumnSnapshot(self.base, self.record_class)
+        except Exception as e:
+            print(e)
+            return None
+        if columns.header['version'] != self.version:
+            return None
+
+        forums = columns.header['forums']
+        attachments = columns.header['attachments']
+        self.seq = columns.header['seq']
+
+        try:
+            f = open(self.journal, 'r+b')
+        except FileNotFoundError:
+            return (forums, attachments, columns, [])
+
+        replayed = []
+        with f:
+            while True:
+                offset = f.tell()
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception as e:
+                    # the last sync died while appending, drop its record
+                    print("dropping partial journal record: %s" % e)
+                    f.truncate(offset)
+                    break
+                if record['seq'] <= self.seq:
+                    continue
+                replayed.extend(apply_record(forums, attachments, record))
+                self.seq = record['seq']
+        print("replayed journal up to record %d" % self.seq)
+        return (forums, attachments, columns, replayed)
+
+    def append(self, forums, attachments):
+        '''
+        Journals the changes of one sync: forums maps slugs to
+        (forum metadata, changed threads, new posts, edited posts, deleted
+        posts), where a thread that is gone maps to None; attachments lists
+        the new ones.
+        '''
+        self.seq += 1
+        with open(self.journal, 'ab') as f:
+            pickle.dump({
+                'seq': self.seq,
+                'forums': forums,
+                'attachments': attachments
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def journal_size(self):
+        try:
+            return os.path.getsize(self.journal)
+        except OSError:
+            return 0
+
+    def compact(self, forums, attachments, posts):
+        '''
+        Writes the full state into a new snapshot, empties the journal and
+        returns the new snapshot's ColumnSnapshot. posts maps slugs to
+        their posts in article number order.
+        '''
+        temp = self.base + '.tmp'
+        with open(temp, 'wb') as f:
+            write_columns(f, {
+                'version': self.version,
+                'seq': self.seq,
+                'forums': forums,
+                'attachments': attachments
+            }, posts)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.base)
+        # records up to self.seq are in the snapshot now
+        with open(self.journal, 'wb'):
+            pass
+        print("compacted forums into %s" % self.base)
+        return ColumnSnapshot(self.base, self.record_class)
+
+
+def apply_record(forums, attachments, record):
+    '''
+    Applies a journal record to the crawl state and returns the
+    (slug, new posts, edited posts, deleted posts) it carries
+    '''
+    posts = []
+    for slug, (meta, threads, new_posts, patched, deleted) in record['forums'].items():
+        forum = forums.setdefault(slug, {'threads': {}})
+        forum.update(meta)
+        for thread_id, thread in threads.items():
+            if thread is None:
+                forum['threads'].pop(thread_id, None)
+            else:
+                forum['threads'][thread_id] = thread
+        posts.append((slug, new_posts, patched, deleted))
+    attachments.extend(record['attachments'])
+    return posts
+
+
+def write_columns(f, header, posts):
+    '''
+    Writes a snapshot: one fixed-width array per column, the per-forum
+    date order, a post ID index and the string table, followed by the
+    header (pickled, with the layout of the rest added) and its offset.
+    Arrays are in native byte order and 8 byte aligned, so they can be
+    used from the mapped file as they are.
+    '''
+    strings = {}
+    string_data = []
+
+    def string(value):
+        if value is None:
+            return NONE
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(string_data)
+            string_data.append(value.encode('utf-8'))
+        return index
+
+    columns = dict((name, array.array('q')) for name in INT_COLUMNS)
+    columns.update((name, array.array('I')) for name in STRING_COLUMNS)
+    # per forum, the rows in date order and their dates, for bisecting by date
+    columns['date_rows'] = array.array('I')
+    columns['dates'] = array.array('q')
+    layout = {}
+    for slug, records in posts.items():
+        start = len(columns['post_id'])
+        for record in records:
+            for name in INT_COLUMNS:
+                columns[name].append(getattr(record, name))
+            for name in STRING_COLUMNS:
+                columns[name].append(string(getattr(record, name)))
+        count = len(columns['post_id']) - start
+        by_date = sorted(range(start, start + count), key=lambda row: columns['post_date'][row])
+        columns['date_rows'].extend(by_date)
+        columns['dates'].extend(columns['post_date'][row] for row in by_date)
+        layout[slug] = (start, count)
+
+    # post IDs of all forums, sorted, and their rows
+    by_id = sorted(range(len(columns['post_id'])), key=lambda row: columns['post_id'][row])
+    columns['id_index'] = array.array('q', (columns['post_id'][row] for row in by_id))
+    columns['id_rows'] = array.array('I', by_id)
+
+    offsets = array.array('Q', [0])
+    for data in string_data:
+        offsets.append(offsets[-1] + len(data))
+    columns['string_offsets'] = offsets
+
+    # the magic is 8 bytes long, which keeps the arrays aligned
+    f.write(MAGIC)
+    position = len(MAGIC)
+    sections = {}
+    for name, column in columns.items():
+        data = column.tobytes()
+        sections[name] = (position, column.typecode, len(column))
+        f.write(data)
+        f.write(b'\0' * (align(len(data)) - len(data)))
+        position += align(len(data))
+    sections['strings'] = (position, 'B', offsets[-1])
+    for data in string_data:
+        f.write(data)
+    position += offsets[-1]
+
+    f.write(pickle.dumps(dict(header, byteorder=sys.byteorder,
+                              forums_layout=layout, sections=sections)))
+    f.write(array.array('Q', [position]).tobytes())
+
+
+def align(size):
+    return (size + 7) & ~7
+
+
+class ColumnSnapshot:
+    '''
+    A snapshot file mapped into memory. Only the header is unpickled, the
+    columns are used straight from the mapping, so loading takes about as
+    long as opening the file, pages are read in as they are used, and
+    forked server processes share them through the page cache. Records
+    are built from a row whenever a reader asks for one.
+    '''
+
+    def __init__(self, path, record_class):
+        self.record_class = record_class
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a snapshot' % path)
+        view = memoryview(self.map)
+        # the header is at the end, followed by its offset
+        offset = view[-8:].cast('Q')[0]
+        self.header = pickle.loads(self.map[offset:-8])
+        if self.header['byteorder'] != sys.byteorder:
+            raise ValueError('%s was written on a machine of different byte order' % path)
+
+        self.columns = {}
+        for name, (offset, typecode, length) in self.header['sections'].items():
+            size = length * array.array(typecode).itemsize
+            self.columns[name] = view[offset:offset + size].cast(typecode)
+        self.strings = self.columns.pop('strings')
+
+    def forum(self, slug):
+        '''Returns the ColumnForum of a forum, or None if it has no rows'''
+        if slug not in self.header['forums_layout']:
+            return None
+        start, count = self.header['forums_layout'][slug]
+        return ColumnForum(self, start, count)
+
+    def string(self, index):
+        if index == NONE:
+            return None
+        offsets = self.columns['string_offsets']
+        return bytes(self.strings[offsets[index]:offsets[index + 1]]).decode('utf-8')
+
+    def column(self, name, row):
+        '''Returns one column of a row, decoding only that one string'''
+        if name in STRING_COLUMNS:
+            return self.string(self.columns[name][row])
+        return self.columns[name][row]
+
+    def record(self, row):
+        '''Builds the record stored in a row'''
+        state = {}
+        for name in INT_COLUMNS:
+            state[name] = self.columns[name][row]
+        for name in STRING_COLUMNS:
+            state[name] = self.string(self.columns[name][row])
+        record = self.record_class.__new__(self.record_class)
+        record.__setstate__(state)
+        return record
+
+    def find(self, post_id):
+        '''Returns the record of a post ID, or None'''
+        index = self.columns['id_index']
+        position = bisect.bisect_left(index, post_id)
+        if position == len(index) or index[position] != post_id:
+            return None
+        return self.record(self.columns['id_rows'][position])
+
+
+class ColumnForum:
+    '''The rows of one forum in a ColumnSnapshot'''
+
+    def __init__(self, columns, start, count):
+        self.columns = columns
+        self.start = start
+        self.count = count
+        # article numbers of the forum, sorted
+        self.numbers = columns.columns['article_number'][start:start + count]
+        # the forum's rows in date order, and their dates
+        self.date_rows = columns.columns['date_rows'][start:start + count]
+        self.dates = columns.columns['dates'][start:start + count]
+
+    def get_article(self, number):
+        position = bisect.bisect_left(self.numbers, number)
+        if position == self.count or self.numbers[position] != number:
+            return None
+        return self.columns.record(self.start + position)
+
+    def positions(self, start, end=None):
+        '''Returns the range of positions numbered start to end (inclusive)'''
+        low = bisect.bisect_left(self.numbers, start)
+        if end is None:
+            high = self.count
+        else:
+            high = bisect.bisect_right(self.numbers, end)
+        return range(low, high)
+
+    def article_range(self, start, end=None):
+        return [self.columns.record(self.start + position) for position in self.positions(start, end)]
+
+    def overview_range(self, start, end=None):
+        '''
+        Returns (article number, overview line) of the rows numbered start
+        to end, in number order. Only the overview column is decoded.
+        '''
+        column = self.columns.column
+        return [(self.numbers[position], column('overview', self.start + position))
+                for position in self.positions(start, end)]
+
+    def records_since(self, date):
+        '''Yields the records dated date or later, in date order'''
+        for position in range(bisect.bisect_left(self.dates, date), self.count):
+            yield self.columns.record(self.date_rows[position])
+
+    def msgids_since(self, date):
+        '''
+        Yields (date, article number, message id) of the rows dated date
+        or later, in date order. Only the message id column is decoded.
+        '''
+        column = self.columns.column
+        for position in range(bisect.bisect_left(self.dates, date), self.count):
+            row = self.date_rows[position]
+            yield (self.dates[position], column('article_number', row),
+                   column('nntp_message_id', row))
+
+    def records(self):
+        '''Yields all records of the forum in article number order'''
+        for position in range(self.count):
+            yield self.columns.record(self.start + position)
+
+    def thread_records(self, thread_ids):
+        '''Yields the records of the posts in the given threads'''
+        column = self.columns.columns['thread_id']
+        for row in range(self.start, self.start + self.count):
+            if column[row] in thread_ids:
+                yield self.columns.record(row)
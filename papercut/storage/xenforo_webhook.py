@@ -0,0 +1,53 @@
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    '''
+    Accepts XenForo webhook deliveries: a POST with a JSON body holding
+    content_type, content_id, event and data, and the shared secret in the
+    XF-Webhook-Secret header.
+    '''
+
+    def do_POST(self):
+        secret = self.headers.get('XF-Webhook-Secret', '')
+        if not hmac.compare_digest(secret.encode('utf-8'), self.server.secret.encode('utf-8')):
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400)
+            return
+        try:
+            applied = self.server.xenforo.apply_webhook(payload)
+        except Exception as e:
+            print("webhook failed: %s" % e)
+            self.send_error(500)
+            return
+        # 202 for deliveries left to the next reconciliation sync
+        self.send_response(200 if applied else 202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_listener(xenforo, address, port, secret):
+    '''
+    Starts an HTTP server on a daemon thread that hands webhook payloads
+    to xenforo.apply_webhook(), and returns it
+    '''
+    server = ThreadingHTTPServer((address, port), WebhookHandler)
+    server.daemon_threads = True
+    server.xenforo = xenforo
+    server.secret = secret
+    thread = threading.Thread(target=server.serve_forever,
+                              name='xenforo-webhooks', daemon=True)
+    thread.start()
+    print("listening for XenForo webhooks on %s:%d" % (address, port))
+    return server
@@ -70,6 +70,8 @@ setup(
             'papercut=papercut.cmd.papercut_nntp:main',
             'papercut_config=papercut.cmd.config:main',
             'papercut_healthcheck=papercut.cmd.check_health:main',
+            'papercut_cache_stats=papercut.cmd.cache_stats:main',
+            'papercut_cache_warm=papercut.cmd.cache_warm:main',
         ],
     },
 )